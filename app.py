@@ -1,58 +1,127 @@
-from copy import deepcopy
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import streamlit as st
 
 from assemble_utils import upload_to_assemble, upload_to_s3
-from utils import data_to_webvtt, vtt_string_to_dataframe
+from ingest import ingest_upload
+from s3_upload import Progress
+from utils import EditableSubtitles, vtt_string_to_dataframe
 
 st.set_page_config(layout="wide")
 
+# Seconds between two looks at the state of the transcriptions.
+status_interval = 2
+
 if "processed_files" not in st.session_state:
     st.session_state.processed_files = dict()
 
 st.header("Generate Subtitles with Assembly AI, and edit them in place!", divider=True)
-uploaded_file = st.file_uploader("Upload a video to caption", type=["mp4", "webm"])
+uploaded_files = st.file_uploader(
+    "Upload videos to caption", type=["mp4", "webm"], accept_multiple_files=True
+)
 
 left, _, right = st.columns([45, 10, 45])
 
-if uploaded_file is not None:
-    if uploaded_file.file_id not in st.session_state.processed_files:
-        st.session_state.processed_files = dict()
-        st.session_state.processed_files[uploaded_file.file_id] = {
-            "file": uploaded_file,
-            "status": "pending",
-            "public_url": None,
-            "vtt": "",
-        }
-        public_url = upload_to_s3(deepcopy(uploaded_file))
-        st.session_state.processed_files[uploaded_file.file_id][
-            "public_url"
-        ] = public_url
-        st.session_state.processed_files[uploaded_file.file_id][
-            "status"
-        ] = "uploaded_to_s3"
-
-if st.session_state.processed_files:
-    for file_id, file_data in st.session_state.processed_files.items():
-        if file_data["status"] == "uploaded_to_s3":
-            vtt_text = upload_to_assemble(file_data["public_url"])
-            st.session_state.processed_files[file_id]["status"] = "processed"
-            st.session_state.processed_files[file_id]["vtt"] = vtt_text
-        elif file_data["status"] == "transcribed":
-            vtt_text = file_data["vtt"]
-        with right:
-            st.download_button(
-                label="Download GENERATED VTT",
-                data=st.session_state.processed_files[file_id]["vtt"],
-                file_name=f"{file_data['file'].name}.vtt",
-                mime="text/vtt",
+processed_files = st.session_state.processed_files
+
+# Forget files that were removed from the uploader.
+uploaded_ids = {f.file_id for f in uploaded_files}
+for file_id in list(processed_files):
+    if file_id not in uploaded_ids:
+        del processed_files[file_id]
+
+for uploaded_file in uploaded_files:
+    if uploaded_file.file_id in processed_files:
+        continue
+
+    ingested = ingest_upload(uploaded_file)
+    progress = Progress(ingested.size)
+    progress_bar = st.progress(0.0, text=f"Uploading {uploaded_file.name}")
+    # Upload in the background and show progress from the script thread,
+    # the only one that may update the page.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(
+            upload_to_s3,
+            ingested.path,
+            ingested.sha256,
+            Path(uploaded_file.name).suffix,
+            progress,
+        )
+        while not future.done():
+            progress_bar.progress(
+                progress.fraction, text=f"Uploading {uploaded_file.name}"
             )
+            time.sleep(0.2)
+    progress_bar.empty()
+
+    processed_files[uploaded_file.file_id] = {
+        "file": uploaded_file,
+        "media_hash": ingested.sha256,
+        "public_url": future.result(),
+    }
+
+# Submitting is cheap and returns the job already in progress, so this also
+# resubmits files whose job was lost, e.g. when the server restarted.
+jobs = {
+    file_id: upload_to_assemble(file_data["media_hash"], file_data["public_url"])
+    for file_id, file_data in processed_files.items()
+}
+finished = {file_id for file_id, job in jobs.items() if job.done}
+
+
+def show_status():
+    rows = []
+    for file_id, file_data in processed_files.items():
+        job = jobs[file_id]
+        rows.append(
+            {"file": file_data["file"].name, "status": job.state, "error": job.error}
+        )
+    if rows:
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+
+    # Rerun the whole page when a result arrives, to offer it for editing.
+    if {file_id for file_id, job in jobs.items() if job.done} != finished:
+        st.rerun()
+
+
+with left:
+    # Poll only while some transcription is still running.
+    st.fragment(
+        show_status, run_every=status_interval if len(finished) < len(jobs) else None
+    )()
+
+completed = [
+    file_id for file_id in processed_files if jobs[file_id].state == "completed"
+]
+
+if completed:
+    with left:
+        file_id = st.selectbox(
+            "Edit subtitles of",
+            completed,
+            format_func=lambda file_id: processed_files[file_id]["file"].name,
+        )
+    file_data = processed_files[file_id]
+    generated_vtt = jobs[file_id].vtt
+
+    with right:
+        st.download_button(
+            label="Download GENERATED VTT",
+            data=generated_vtt,
+            file_name=f"{file_data['file'].name}.vtt",
+            mime="text/vtt",
+        )
 
-if item := list(st.session_state.processed_files.values()):
-    df = vtt_string_to_dataframe(item[0]["vtt"])
+    if "editable" not in file_data:
+        file_data["editable"] = EditableSubtitles(vtt_string_to_dataframe(generated_vtt))
+    editable = file_data["editable"]
+    editor_key = f"subtitle_editor_{file_id}"
     with left:
         edited_df = st.data_editor(
-            df,
+            editable.base,
+            key=editor_key,
             use_container_width=True,
             column_config={
                 "text": st.column_config.TextColumn(
@@ -70,10 +139,11 @@ if item := list(st.session_state.processed_files.values()):
             },
         )
 
-    edited_webvtt_string = data_to_webvtt(edited_df.to_dict(orient="records"))
+    editable.update(edited_df, st.session_state[editor_key])
+    edited_webvtt_string = editable.vtt
 
     with right:
-        st.video(item[0]["file"], subtitles=edited_webvtt_string)
+        st.video(file_data["file"], subtitles=edited_webvtt_string)
         st.download_button(
             label="Download EDITED VTT",
             data=edited_webvtt_string,
@@ -1,39 +1,49 @@
-import assemblyai as aai
-import boto3
+from functools import lru_cache
+from typing import Callable, Optional
+
 import streamlit as st
 
+from assemblyai_jobs import AssemblyAIClient, AssemblyAIJobs, RemoteJob, VttCache
+from paths import cache_dir
+from s3_upload import content_key, create_client, public_url, upload
+
 AWS_S3_BUCKET_NAME = st.secrets["AWS_S3_BUCKET_NAME"]
 AWS_REGION = st.secrets["AWS_REGION"]
 AWS_ACCESS_KEY = st.secrets["AWS_ACCESS_KEY"]
 AWS_SECRET_KEY = st.secrets["AWS_SECRET_KEY"]
 
 
-@st.cache_data
-def upload_to_s3(uploaded_file):
-    s3_client = boto3.client(
-        service_name="s3",
-        region_name=AWS_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY,
-    )
+@lru_cache(maxsize=1)
+def get_s3_client():
+    return create_client(AWS_REGION, AWS_ACCESS_KEY, AWS_SECRET_KEY)
 
-    s3_client.upload_fileobj(uploaded_file, AWS_S3_BUCKET_NAME, uploaded_file.name)
 
-    url = "https://s3-%s.amazonaws.com/%s/%s" % (
-        AWS_REGION,
-        AWS_S3_BUCKET_NAME,
-        uploaded_file.name,
-    )
-    return url
+def upload_to_s3(
+    filename: str,
+    sha256: str,
+    suffix: str = "",
+    callback: Optional[Callable[[int], None]] = None,
+) -> str:
+    """Upload filename under its content hash, unless it is already in the
+    bucket, and return its public URL."""
+    key = content_key(sha256, suffix)
+    upload(get_s3_client(), AWS_S3_BUCKET_NAME, filename, key, callback)
+    return public_url(AWS_REGION, AWS_S3_BUCKET_NAME, key)
 
 
-aai.settings.api_key = st.secrets["ASSEMBLYAI_API_KEY"]
-transcriber = aai.Transcriber()
+@lru_cache(maxsize=1)
+def get_assemblyai_jobs() -> AssemblyAIJobs:
+    # One poller per process, shared by all sessions.
+    return AssemblyAIJobs(
+        AssemblyAIClient(st.secrets["ASSEMBLYAI_API_KEY"]),
+        VttCache(cache_dir / "assemblyai"),
+    )
 
 
-@st.cache_data
-def upload_to_assemble(file_url):
-    transcript = transcriber.transcribe(file_url)
-    subtitles = transcript.export_subtitles_vtt()
+def upload_to_assemble(media_hash: str, file_url: str) -> RemoteJob:
+    """Submit file_url for transcription and return its job without waiting.
 
-    return subtitles
+    Submitting the same media_hash again returns the job in progress, or a
+    completed one from the cache.
+    """
+    return get_assemblyai_jobs().submit(media_hash, file_url)
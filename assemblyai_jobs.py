@@ -0,0 +1,224 @@
+"""Submit transcriptions to AssemblyAI without blocking, and poll them together.
+
+submit() returns at once. The request to create the transcript and every
+later status request run on a pool of SUBTITLE_ASSEMBLYAI_CONCURRENCY
+threads, which bounds the number of requests in flight across all jobs. Each
+job is polled after poll_interval seconds at first, backing off to
+max_poll_interval while it is still processing, and transient HTTP errors are
+retried the same way. Finished subtitles are cached on disk by media hash, so
+the same file is never transcribed twice.
+
+The client talks to the REST API directly; point ASSEMBLYAI_BASE_URL at a
+local mock of it to test without an account.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+base_url = os.environ.get("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com")
+max_concurrency = int(os.environ.get("SUBTITLE_ASSEMBLYAI_CONCURRENCY", "8"))
+
+poll_interval = 1.0
+max_poll_interval = 15.0
+backoff = 1.5
+
+# A job fails after this many HTTP errors in a row.
+max_errors = 5
+
+
+class AssemblyAIClient:
+    def __init__(self, api_key: str, base_url: str = base_url, timeout: float = 30):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, body: Optional[Dict] = None) -> bytes:
+        data = None
+        headers = {"authorization": self.api_key}
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["content-type"] = "application/json"
+        request = urllib.request.Request(
+            self.base_url + path, data=data, headers=headers, method=method
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    def submit(self, audio_url: str) -> str:
+        """Create a transcript and return its ID."""
+        response = self._request("POST", "/v2/transcript", {"audio_url": audio_url})
+        return json.loads(response)["id"]
+
+    def get(self, transcript_id: str) -> Dict:
+        return json.loads(self._request("GET", f"/v2/transcript/{transcript_id}"))
+
+    def vtt(self, transcript_id: str) -> str:
+        return self._request("GET", f"/v2/transcript/{transcript_id}/vtt").decode(
+            "utf-8"
+        )
+
+
+class VttCache:
+    """Finished subtitles, one file per media hash."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, media_hash: str) -> Optional[str]:
+        try:
+            return (self.path / f"{media_hash}.vtt").read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, media_hash: str, vtt: str):
+        path = self.path / f"{media_hash}.vtt"
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(vtt, encoding="utf-8")
+        os.replace(tmp, path)
+
+
+@dataclass
+class RemoteJob:
+    media_hash: str
+    audio_url: str
+    # submitting, then the API's queued or processing, and finally
+    # completed or error.
+    state: str = "submitting"
+    transcript_id: Optional[str] = None
+    vtt: Optional[str] = None
+    error: Optional[str] = None
+    polls: int = 0
+    errors: int = 0
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("completed", "error")
+
+
+class AssemblyAIJobs:
+    def __init__(
+        self,
+        client: AssemblyAIClient,
+        cache: VttCache,
+        max_concurrency: int = max_concurrency,
+        poll_interval: float = poll_interval,
+        max_poll_interval: float = max_poll_interval,
+    ):
+        self.client = client
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrency), thread_name_prefix="assemblyai"
+        )
+
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, RemoteJob] = {}
+        # (due time, tie breaker, request) of the requests waiting to be sent.
+        self._due: List[Tuple[float, int, Callable]] = []
+        self._counter = itertools.count()
+        self._wakeup = threading.Condition(self._lock)
+        threading.Thread(
+            target=self._schedule_loop, name="assemblyai-poll", daemon=True
+        ).start()
+
+    def submit(self, media_hash: str, audio_url: str) -> RemoteJob:
+        """Start transcribing audio_url, unless media_hash is cached or
+        already in progress, and return its job without waiting."""
+        with self._lock:
+            job = self._jobs.get(media_hash)
+            if job is not None and job.state != "error":
+                return job
+
+            job = RemoteJob(media_hash, audio_url)
+            self._jobs[media_hash] = job
+
+        vtt = self.cache.get(media_hash)
+        if vtt is not None:
+            job.vtt = vtt
+            job.state = "completed"
+        else:
+            self._executor.submit(self._submit, job)
+        return job
+
+    def get(self, media_hash: str) -> Optional[RemoteJob]:
+        with self._lock:
+            return self._jobs.get(media_hash)
+
+    def _submit(self, job: RemoteJob):
+        try:
+            job.transcript_id = self.client.submit(job.audio_url)
+        except Exception as e:
+            self._retry(job, e, partial(self._submit, job), self.poll_interval)
+            return
+        job.errors = 0
+        job.state = "queued"
+        self._schedule(partial(self._poll, job, self.poll_interval), self.poll_interval)
+
+    def _poll(self, job: RemoteJob, delay: float):
+        try:
+            transcript = self.client.get(job.transcript_id)
+            job.polls += 1
+            status = transcript["status"]
+            if status == "completed":
+                vtt = self.client.vtt(job.transcript_id)
+                self.cache.put(job.media_hash, vtt)
+                job.vtt = vtt
+            elif status == "error":
+                job.error = transcript.get("error") or "Transcription failed"
+        except Exception as e:
+            self._retry(job, e, partial(self._poll, job, delay), delay)
+            return
+
+        job.errors = 0
+        job.state = status
+        if not job.done:
+            delay = min(delay * backoff, self.max_poll_interval)
+            self._schedule(partial(self._poll, job, delay), delay)
+
+    def _retry(self, job: RemoteJob, error: Exception, action: Callable, delay: float):
+        job.errors += 1
+        # Client errors other than rate limiting will not go away by retrying.
+        permanent = (
+            isinstance(error, urllib.error.HTTPError)
+            and 400 <= error.code < 500
+            and error.code != 429
+        )
+        if permanent or job.errors >= max_errors:
+            logging.warning(f"AssemblyAI job for {job.media_hash} failed: {error}")
+            job.error = str(error)
+            job.state = "error"
+            return
+        self._schedule(action, min(delay * backoff, self.max_poll_interval))
+
+    def _schedule(self, action: Callable, delay: float):
+        with self._wakeup:
+            heapq.heappush(
+                self._due, (time.monotonic() + delay, next(self._counter), action)
+            )
+            self._wakeup.notify()
+
+    def _schedule_loop(self):
+        # Hands due requests to the executor, whose size limits how many run
+        # at the same time.
+        while True:
+            with self._wakeup:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    timeout = None
+                    if self._due:
+                        timeout = self._due[0][0] - time.monotonic()
+                    self._wakeup.wait(timeout)
+                _, _, action = heapq.heappop(self._due)
+            self._executor.submit(action)
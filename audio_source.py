@@ -0,0 +1,332 @@
+"""Decode media files to 16 kHz mono int16 samples, in process when possible.
+
+With PyAV installed (`pip install av`), files are demuxed, decoded and
+resampled in this process, and the samples are copied once, straight from
+the resampler's frames into a preallocated NumPy buffer. Without it, an
+ffmpeg subprocess writes s16le to a pipe, as before. Both backends read the
+file in windows of a fixed number of samples, see open_pcm().
+
+Stream metadata is read the same way, with PyAV or with ffprobe, see probe().
+
+Set SUBTITLE_AUDIO_BACKEND to "ffmpeg" to use the command line tools even if
+PyAV is installed.
+"""
+import json
+import logging
+import os
+import subprocess
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from model import sample_rate
+
+try:
+    import av
+except ImportError:
+    av = None
+
+backend = os.environ.get("SUBTITLE_AUDIO_BACKEND", "av" if av else "ffmpeg")
+if backend == "av" and av is None:
+    logging.warning("PyAV is not installed, decoding audio with ffmpeg")
+    backend = "ffmpeg"
+
+
+def ffmpeg_command(
+    filename: str, start: float = 0, duration: Optional[float] = None
+) -> List[str]:
+    """ffmpeg arguments that write filename as 16 kHz mono s16le to stdout."""
+    ffmpeg_cmd = ["ffmpeg"]
+    if start:
+        ffmpeg_cmd += ["-ss", str(start)]
+    if duration is not None:
+        ffmpeg_cmd += ["-t", str(duration)]
+    ffmpeg_cmd += [
+        "-i",
+        filename,
+        "-f",
+        "s16le",
+        "-acodec",
+        "pcm_s16le",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "-",
+    ]
+    return ffmpeg_cmd
+
+
+class PcmSource:
+    """Samples of a media file, read frames_per_read at a time."""
+
+    # Names the decoding stage in metrics.
+    name = ""
+
+    def __init__(self, frames_per_read: int):
+        self._pcm = np.empty(frames_per_read, dtype=np.int16)
+
+    def read(self) -> np.ndarray:
+        """Read up to frames_per_read samples, an empty array at the end.
+
+        The result is a view that is only valid until the next read.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FfmpegPcmSource(PcmSource):
+    name = "ffmpeg"
+
+    def __init__(
+        self,
+        filename: str,
+        start: float = 0,
+        duration: Optional[float] = None,
+        frames_per_read: int = sample_rate * 100,
+    ):
+        super().__init__(frames_per_read)
+        self._pcm_bytes = memoryview(self._pcm).cast("B")
+        self._process = subprocess.Popen(
+            ffmpeg_command(filename, start, duration),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def read(self) -> np.ndarray:
+        f = self._process.stdout
+        num_bytes = 0
+        while num_bytes < len(self._pcm_bytes):
+            n = f.readinto(self._pcm_bytes[num_bytes:])
+            if not n:
+                break
+            num_bytes += n
+
+        # *2 because int16_t has two bytes
+        return self._pcm[: num_bytes // 2]
+
+    def close(self):
+        self._process.kill()
+        self._process.wait()
+
+
+class AvPcmSource(PcmSource):
+    name = "av"
+
+    def __init__(
+        self,
+        filename: str,
+        start: float = 0,
+        duration: Optional[float] = None,
+        frames_per_read: int = sample_rate * 100,
+    ):
+        super().__init__(frames_per_read)
+        self._container = av.open(filename)
+        try:
+            if not self._container.streams.audio:
+                raise ValueError(f"{filename} has no audio stream")
+            self._stream = self._container.streams.audio[0]
+            if start:
+                # Seeks to the last packet before start, _resampled_frames()
+                # skips the rest.
+                self._container.seek(
+                    int(start / self._stream.time_base), stream=self._stream
+                )
+        except Exception:
+            self._container.close()
+            raise
+
+        self._frames = self._resampled_frames(start, duration)
+        # The part of the last frame that did not fit into the last read.
+        self._pending = self._pcm[:0]
+
+    def _resampled_frames(
+        self, start: float, duration: Optional[float]
+    ) -> Iterator[np.ndarray]:
+        resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+        skip = None if start else 0
+        remaining = None if duration is None else int(duration * sample_rate)
+
+        def decoded():
+            for packet in self._container.demux(self._stream):
+                yield from packet.decode()
+            # Drain the resampler.
+            yield None
+
+        for frame in decoded():
+            if skip is None and frame is not None and frame.time is not None:
+                skip = max(0, round((start - frame.time) * sample_rate))
+            for out in resampler.resample(frame):
+                # A view of the frame's own buffer, copied only by read().
+                samples = np.frombuffer(out.planes[0], np.int16, out.samples)
+                if skip:
+                    n = min(skip, len(samples))
+                    samples = samples[n:]
+                    skip -= n
+                if remaining is not None:
+                    samples = samples[:remaining]
+                    remaining -= len(samples)
+                if len(samples):
+                    yield samples
+                if remaining == 0:
+                    return
+
+    def read(self) -> np.ndarray:
+        num_samples = 0
+        while num_samples < len(self._pcm):
+            if not len(self._pending):
+                self._pending = next(self._frames, None)
+                if self._pending is None:
+                    self._pending = self._pcm[:0]
+                    break
+            n = min(len(self._pcm) - num_samples, len(self._pending))
+            self._pcm[num_samples : num_samples + n] = self._pending[:n]
+            self._pending = self._pending[n:]
+            num_samples += n
+        return self._pcm[:num_samples]
+
+    def close(self):
+        self._frames.close()
+        self._container.close()
+
+
+def open_pcm(
+    filename: str,
+    start: float = 0,
+    duration: Optional[float] = None,
+    frames_per_read: int = sample_rate * 100,
+) -> PcmSource:
+    """Open filename for reading as 16 kHz mono int16 samples.
+
+    start and duration (in seconds) restrict reading to a part of the file.
+    """
+    if backend == "av":
+        return AvPcmSource(filename, start, duration, frames_per_read)
+    return FfmpegPcmSource(filename, start, duration, frames_per_read)
+
+
+def read_pcm(filename: str) -> bytes:
+    """Decode the whole of filename to 16 kHz mono s16le in memory."""
+    data = bytearray()
+    with open_pcm(filename) as source:
+        while True:
+            samples = source.read()
+            if not len(samples):
+                break
+            data += memoryview(samples).cast("B")
+    return bytes(data)
+
+
+@dataclass
+class MediaInfo:
+    filename: str
+    format_name: str
+    duration: float
+    # One description per stream, e.g. "audio: aac, 44100 Hz, 2 channels".
+    streams: List[str] = field(default_factory=list)
+
+    def __str__(self):
+        lines = [f"{self.filename}: {self.format_name}, {self.duration:.2f} s"]
+        lines += [f"  {s}" for s in self.streams]
+        return "\n".join(lines)
+
+
+def _describe_stream(
+    codec_type: str,
+    codec_name: Optional[str],
+    sample_rate: Optional[int] = None,
+    channels: Optional[int] = None,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+) -> str:
+    s = f"{codec_type}: {codec_name or 'unknown'}"
+    if codec_type == "audio":
+        s += f", {sample_rate} Hz, {channels} channels"
+    elif codec_type == "video":
+        s += f", {width}x{height}"
+    return s
+
+
+def _probe_av(filename: str) -> MediaInfo:
+    with av.open(filename) as container:
+        if container.duration is not None:
+            duration = container.duration / av.time_base
+        else:
+            duration = max(
+                (
+                    float(s.duration * s.time_base)
+                    for s in container.streams
+                    if s.duration is not None
+                ),
+                default=0.0,
+            )
+
+        streams = []
+        for s in container.streams:
+            codec = s.codec_context
+            streams.append(
+                _describe_stream(
+                    s.type,
+                    codec.name if codec else None,
+                    getattr(codec, "sample_rate", None),
+                    getattr(codec, "channels", None),
+                    getattr(codec, "width", None),
+                    getattr(codec, "height", None),
+                )
+            )
+        return MediaInfo(filename, container.format.name, duration, streams)
+
+
+def _probe_ffprobe(filename: str) -> MediaInfo:
+    ffprobe_cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=format_name,duration"
+        ":stream=codec_type,codec_name,sample_rate,channels,width,height",
+        "-of",
+        "json",
+        filename,
+    ]
+    output = subprocess.run(
+        ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True
+    ).stdout
+    info = json.loads(output)
+    streams = [
+        _describe_stream(
+            s.get("codec_type", "unknown"),
+            s.get("codec_name"),
+            s.get("sample_rate"),
+            s.get("channels"),
+            s.get("width"),
+            s.get("height"),
+        )
+        for s in info.get("streams", [])
+    ]
+    return MediaInfo(
+        filename,
+        info["format"]["format_name"],
+        float(info["format"]["duration"]),
+        streams,
+    )
+
+
+def probe(filename: str) -> MediaInfo:
+    """Container format, duration and streams of filename."""
+    if backend == "av":
+        return _probe_av(filename)
+    return _probe_ffprobe(filename)
+
+
+def probe_duration(filename: str) -> float:
+    return probe(filename).duration
@@ -0,0 +1,224 @@
+"""Generate subtitles for many videos without the web UI.
+
+Usage:
+
+    python batch.py --model whisper-tiny.en [--format vtt srt] [--workers 4]
+        [--manifest videos.txt] [--force] [--sharded] [path ...]
+
+Every path is a video or a directory that is searched recursively for
+videos. A manifest lists one video per line, relative to the manifest.
+Subtitles are written next to each video, e.g. talk.mp4 -> talk.vtt, or
+talk.mp4.vtt if another video of the run is also named talk, e.g. talk.webm.
+Videos whose subtitles are newer than the video itself are skipped unless
+--force is given.
+
+Videos are decoded on a pool of worker processes, one recognizer each. With
+--sharded, videos are instead decoded one after another, each split into
+time shards across all workers (see sharded_decode.py), which suits a few
+long videos better than many short ones.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+from segment_table import SegmentTable
+
+video_extensions = {".mp4", ".webm", ".mkv", ".mov", ".avi", ".mp3", ".wav", ".m4a"}
+
+
+def find_videos(paths: Iterable[str], manifests: Iterable[str]) -> List[Path]:
+    videos = []
+    for manifest in manifests:
+        base = Path(manifest).parent
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    videos.append(base / line)
+
+    for path in map(Path, paths):
+        if path.is_dir():
+            videos.extend(
+                sorted(
+                    p
+                    for p in path.rglob("*")
+                    if p.suffix.lower() in video_extensions and p.is_file()
+                )
+            )
+        else:
+            videos.append(path)
+
+    return list(dict.fromkeys(videos))
+
+
+def output_paths(
+    video: Path, formats: List[str], keep_extension: bool = False
+) -> List[Path]:
+    if keep_extension:
+        return [video.with_name(f"{video.name}.{fmt}") for fmt in formats]
+    return [video.with_suffix(f".{fmt}") for fmt in formats]
+
+
+def all_output_paths(videos: List[Path], formats: List[str]) -> Dict[Path, List[Path]]:
+    """Output paths of every video. Videos that differ only in their
+    extension keep it in their output names, so that they do not overwrite
+    each other's subtitles."""
+    stems = Counter(video.resolve().with_suffix("") for video in videos)
+    return {
+        video: output_paths(
+            video, formats, stems[video.resolve().with_suffix("")] > 1
+        )
+        for video in videos
+    }
+
+
+def is_up_to_date(video: Path, outputs: List[Path]) -> bool:
+    mtime = video.stat().st_mtime
+    return all(out.exists() and out.stat().st_mtime >= mtime for out in outputs)
+
+
+def write_outputs(table: SegmentTable, outputs: List[Path]):
+    for out in outputs:
+        # Write to a temporary file first, so that an interrupted run does
+        # not leave a truncated file that looks up to date.
+        tmp = out.with_name(f".{out.name}.{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            table.write(f, out.suffix[1:])
+        os.replace(tmp, out)
+
+
+def _transcribe(repo_id: str, video: Path, outputs: List[Path]) -> Tuple[float, int]:
+    # Imported here so the models are only loaded in the worker processes.
+    from decode import decode_segments
+    from model import checkout_recognizers, checkout_vad, session_options
+
+    position = 0.0
+
+    def on_progress(seconds):
+        nonlocal position
+        position = seconds
+
+    # The recognizer stays loaded in the worker for the next video.
+    with checkout_recognizers(repo_id, 1) as recognizers, checkout_vad() as vad:
+        table = SegmentTable.from_segments(
+            decode_segments(
+                recognizers,
+                vad,
+                str(video),
+                max_batch_size=session_options.get(repo_id).batch_size,
+                on_progress=on_progress,
+            )
+        )
+
+    write_outputs(table, outputs)
+    return position, len(table)
+
+
+def _transcribe_sharded(
+    repo_id: str, video: Path, outputs: List[Path], num_workers: int
+) -> Tuple[float, int]:
+    from audio_source import probe_duration
+    from sharded_decode import decode_sharded
+
+    table = SegmentTable.from_segments(
+        decode_sharded(repo_id, str(video), num_workers=num_workers)
+    )
+    write_outputs(table, outputs)
+    return probe_duration(str(video)), len(table)
+
+
+def main():
+    from model import language_to_models, session_options
+
+    models = list(dict.fromkeys(m for ms in language_to_models.values() for m in ms))
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--manifest", action="append", default=[])
+    parser.add_argument("--model", required=True, choices=models)
+    parser.add_argument(
+        "--format", nargs="+", choices=["vtt", "srt"], default=["vtt"]
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--sharded", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    num_workers = args.workers
+    if num_workers is None:
+        num_threads = session_options.get(args.model).num_threads
+        num_workers = max(1, (os.cpu_count() or 1) // num_threads)
+
+    videos = find_videos(args.paths, args.manifest)
+    found = []
+    for video in videos:
+        if video.is_file():
+            found.append(video)
+        else:
+            logging.warning(f"Skipping {video}: not found")
+    todo = []
+    for video, outputs in all_output_paths(found, args.format).items():
+        if not args.force and is_up_to_date(video, outputs):
+            continue
+        todo.append((video, outputs))
+    print(f"{len(todo)} of {len(videos)} videos need subtitles")
+
+    audio_seconds = 0.0
+    failed = 0
+    start = time.monotonic()
+
+    def report(video, result):
+        nonlocal audio_seconds
+        seconds, num_segments = result
+        audio_seconds += seconds
+        print(f"{video}: {seconds:.0f} s, {num_segments} cues", flush=True)
+
+    if args.sharded:
+        for video, outputs in todo:
+            try:
+                report(
+                    video,
+                    _transcribe_sharded(args.model, video, outputs, num_workers),
+                )
+            except Exception:
+                logging.exception(f"Failed to transcribe {video}")
+                failed += 1
+    elif todo:
+        # Worker processes are spawned, since forking a process that runs
+        # ONNX Runtime threads is not safe.
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(todo)),
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = {
+                executor.submit(_transcribe, args.model, video, outputs): video
+                for video, outputs in todo
+            }
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], future.result())
+                except Exception:
+                    logging.exception(f"Failed to transcribe {futures[future]}")
+                    failed += 1
+
+    wall_seconds = time.monotonic() - start
+    print(
+        f"Transcribed {audio_seconds / 3600:.2f} h of audio in "
+        f"{wall_seconds / 3600:.2f} h: "
+        f"{audio_seconds / max(wall_seconds, 1e-9):.1f} audio-hours per wall-hour, "
+        f"{failed} failed"
+    )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
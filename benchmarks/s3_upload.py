@@ -0,0 +1,86 @@
+"""Throughput of s3_upload against boto3's default transfer settings.
+
+Usage (from the repository root):
+
+    python -m benchmarks.s3_upload [--endpoint-url http://127.0.0.1:5000]
+        [--size-mb 256 1024] [--bucket subtitle-bench]
+
+Without --endpoint-url, an in-process moto server is started, which needs
+`pip install "moto[server]"`; point --endpoint-url at MinIO or real S3 for
+numbers that include the network. For every size, a file of random bytes is
+uploaded with boto3's defaults and with s3_upload's tuned multipart
+settings, and then once more with s3_upload, which the HEAD check turns
+into a no-op.
+"""
+import argparse
+import os
+import tempfile
+import time
+import uuid
+
+from boto3.s3.transfer import TransferConfig
+
+import s3_upload
+
+
+def start_moto_server() -> str:
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return f"http://{host}:{port}"
+
+
+def timed(f, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--endpoint-url")
+    parser.add_argument("--region", default="us-east-1")
+    parser.add_argument("--bucket", default="subtitle-bench")
+    parser.add_argument("--size-mb", nargs="+", type=int, default=[256, 1024])
+    args = parser.parse_args()
+
+    endpoint_url = args.endpoint_url
+    if endpoint_url is None:
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+        endpoint_url = start_moto_server()
+
+    client = s3_upload.create_client(args.region, endpoint_url=endpoint_url)
+    try:
+        client.create_bucket(Bucket=args.bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    for size_mb in args.size_mb:
+        with tempfile.NamedTemporaryFile() as f:
+            for _ in range(size_mb):
+                f.write(os.urandom(1024 * 1024))
+            f.flush()
+
+            default = timed(
+                client.upload_file,
+                f.name,
+                args.bucket,
+                f"default/{uuid.uuid4().hex}",
+                Config=TransferConfig(),
+            )
+            key = s3_upload.content_key(uuid.uuid4().hex)
+            tuned = timed(s3_upload.upload, client, args.bucket, f.name, key)
+            skipped = timed(s3_upload.upload, client, args.bucket, f.name, key)
+
+        print(
+            f"{size_mb} MiB: default {size_mb / default:.0f} MiB/s, "
+            f"tuned {size_mb / tuned:.0f} MiB/s, "
+            f"duplicate skipped in {skipped * 1000:.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Tail latency and throughput with and without bounded segments and buckets.
+
+Usage (from the repository root):
+
+    python -m benchmarks.segment_length [--models ...] [--filename example.mp4]
+        [--loops 4] [--max-segment-seconds 20]
+
+Decodes the input, looped --loops times, with every model in three ways:
+
+    unbounded   VAD segments as they are, batches in file order (the old
+                behavior)
+    bounded     segments split to --max-segment-seconds, batches in file order
+    bucketed    segments split, and batched by duration bucket
+
+and prints, per model, the throughput in audio seconds per second and the
+p50/p95/p99 latency of a segment, i.e. the time from the start of recognition
+until the decode_streams() call holding the segment returned, with the change
+relative to unbounded. Models are only read from the local Hugging Face
+cache; every model runs in a fresh process.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from benchmarks.service_load import percentile
+from benchmarks.suite import make_long_input
+
+variants = ["unbounded", "bounded", "bucketed"]
+
+
+def _run_one(repo_id: str, filename: str, max_segment_seconds: float) -> Dict:
+    from audio_source import read_pcm
+    from decode import duration_batches, duration_buckets, vad_split
+    from model import _load_pretrained_model, create_vad, sample_rate, session_options
+
+    data = read_pcm(filename)
+    audio_seconds = len(data) / 2 / sample_rate
+    recognizer = _load_pretrained_model(repo_id)
+    vad = create_vad()
+    batch_size = session_options.get(repo_id).batch_size
+
+    results = {}
+    for variant in variants:
+        vad.reset()
+        segments, samples = vad_split(
+            vad, data, 0 if variant == "unbounded" else max_segment_seconds
+        )
+        buckets = duration_buckets if variant == "bucketed" else None
+
+        streams = []
+        for s in samples:
+            stream = recognizer.create_stream()
+            stream.accept_waveform(sample_rate, s)
+            streams.append(stream)
+
+        latencies: List[float] = []
+        start = time.perf_counter()
+        for batch in duration_batches(samples, batch_size, buckets):
+            recognizer.decode_streams([streams[i] for i in batch])
+            latencies += [time.perf_counter() - start] * len(batch)
+        elapsed = time.perf_counter() - start
+
+        results[variant] = {
+            "num_segments": len(segments),
+            "longest_segment_seconds": max(s.duration for s in segments),
+            "audio_seconds_per_second": audio_seconds / elapsed,
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+        }
+    return results
+
+
+def _change(value: float, baseline: float) -> str:
+    return f"{value / baseline - 1:+.0%}" if baseline else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", nargs="+")
+    parser.add_argument("--filename", default="example.mp4")
+    parser.add_argument("--loops", type=int, default=4)
+    parser.add_argument("--max-segment-seconds", type=float, default=20)
+    args = parser.parse_args()
+
+    os.environ["HF_HUB_OFFLINE"] = "1"
+
+    from model import language_to_models
+
+    models = args.models or list(
+        dict.fromkeys(m for models in language_to_models.values() for m in models)
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = args.filename
+        if args.loops > 1:
+            filename = make_long_input(args.filename, args.loops, Path(tmp))
+
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1,
+        ) as executor:
+            for repo_id in models:
+                try:
+                    results = executor.submit(
+                        _run_one, repo_id, filename, args.max_segment_seconds
+                    ).result()
+                except Exception as e:
+                    print(f"{repo_id} failed: {e}", file=sys.stderr)
+                    continue
+
+                print(repo_id)
+                baseline = results["unbounded"]
+                for variant in variants:
+                    r = results[variant]
+                    throughput = r["audio_seconds_per_second"]
+                    throughput_change = _change(
+                        throughput, baseline["audio_seconds_per_second"]
+                    )
+                    print(
+                        f"  {variant:>10}: {r['num_segments']:>4} segments "
+                        f"(longest {r['longest_segment_seconds']:.1f}s), "
+                        f"{throughput:.1f} audio s/s ({throughput_change}), "
+                        + " ".join(
+                            f"{q}={r[q]:.2f}s ({_change(r[q], baseline[q])})"
+                            for q in ("p50", "p95", "p99")
+                        )
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Load test of service.py with many small concurrent requests.
+
+Usage (from the repository root, with `python service.py` running):
+
+    python -m benchmarks.service_load --model whisper-tiny.en
+        [--url http://127.0.0.1:8000] [--clips 32] [--clip-seconds 10]
+        [--concurrency 1 4 16]
+
+Cuts --clips short clips out of --filename and posts all of them at each
+concurrency level, with the transcript cache bypassed. Concurrency 1 is
+one-file-at-a-time processing; at higher levels the service can batch the
+segments of different requests together. Prints requests per second, audio
+seconds decoded per second and latency percentiles per level.
+"""
+import argparse
+import subprocess
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+from audio_source import probe_duration
+
+
+def make_clips(filename: str, num_clips: int, seconds: float, out_dir: Path) -> List[Path]:
+    total = probe_duration(filename)
+    clips = []
+    for i in range(num_clips):
+        # Spread the clips over the file, so that they differ in content.
+        start = (i * seconds * 0.7) % max(1.0, total - seconds)
+        out = out_dir / f"clip{i:04d}.mp4"
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-ss",
+                str(start),
+                "-t",
+                str(seconds),
+                "-i",
+                filename,
+                "-vn",
+                "-c:a",
+                "copy",
+                str(out),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        clips.append(out)
+    return clips
+
+
+def post(url: str, clip: Path) -> float:
+    start = time.perf_counter()
+    request = urllib.request.Request(url, data=clip.read_bytes(), method="POST")
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--model", required=True)
+    parser.add_argument("--filename", default="example.mp4")
+    parser.add_argument("--clips", type=int, default=32)
+    parser.add_argument("--clip-seconds", type=float, default=10)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    args = parser.parse_args()
+
+    query = urllib.parse.urlencode({"model": args.model, "cache": "0"})
+    url = f"{args.url}/transcribe?{query}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = make_clips(args.filename, args.clips, args.clip_seconds, Path(tmp))
+        audio_seconds = sum(probe_duration(str(c)) for c in clips)
+
+        # Warm up, so that model loading is not timed.
+        post(url, clips[0])
+
+        for concurrency in args.concurrency:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                latencies = list(executor.map(lambda c: post(url, c), clips))
+            elapsed = time.perf_counter() - start
+            print(
+                f"concurrency={concurrency:>3}: "
+                f"{len(clips) / elapsed:.2f} req/s, "
+                f"{audio_seconds / elapsed:.1f} audio s/s, "
+                f"p50={percentile(latencies, 0.5):.2f}s "
+                f"p95={percentile(latencies, 0.95):.2f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Offline benchmark of every model in model.language_to_models.
+
+Usage (from the repository root):
+
+    python -m benchmarks.suite run [--models ...] [--loops 1 8] [-o results.json]
+    python -m benchmarks.suite compare baseline.json results.json [--threshold 0.1]
+
+`run` decodes example.mp4, and copies of it looped --loops times, with each
+model and writes the real-time factor, peak RSS and per-stage wall time
+(ffmpeg decode, VAD, ASR, subtitle serialization) as JSON. The stages run one
+after another over the whole input rather than interleaved as in
+decode.decode_segments, so that each one can be timed on its own. Every run
+happens in a fresh process, so peak RSS covers one model only. Models are
+only read from the local Hugging Face cache.
+
+`compare` exits with status 1 if any metric got worse than the baseline by
+more than --threshold (relative).
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+stages = ["ffmpeg", "vad", "asr", "serialization"]
+
+
+def make_long_input(filename: str, loops: int, out_dir: Path) -> str:
+    out = out_dir / f"{Path(filename).stem}_x{loops}.mp4"
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-stream_loop",
+            str(loops - 1),
+            "-i",
+            filename,
+            "-vn",
+            "-c:a",
+            "copy",
+            str(out),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=True,
+    )
+    return str(out)
+
+
+def _run_one(repo_id: str, filename: str) -> Dict:
+    from audio_source import read_pcm
+    from decode import _decode_batch, vad_split
+    from model import _load_pretrained_model, create_vad, sample_rate, session_options
+    from subtitle_writer import segments_to_vtt
+
+    timings = {}
+
+    start = time.perf_counter()
+    data = read_pcm(filename)
+    timings["ffmpeg"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    recognizer = _load_pretrained_model(repo_id)
+    vad = create_vad()
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    segments, samples = vad_split(vad, data)
+    timings["vad"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _decode_batch(
+        recognizer, segments, samples, session_options.get(repo_id).batch_size
+    )
+    timings["asr"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    segments_to_vtt(segments)
+    timings["serialization"] = time.perf_counter() - start
+
+    audio_seconds = len(data) / 2 / sample_rate
+    return {
+        "model": repo_id,
+        "input": Path(filename).name,
+        "audio_seconds": audio_seconds,
+        "num_segments": len(segments),
+        "load_seconds": load_seconds,
+        "rtf": sum(timings.values()) / audio_seconds,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "stages": timings,
+    }
+
+
+def run(args):
+    os.environ["HF_HUB_OFFLINE"] = "1"
+
+    from model import language_to_models
+    from session_options import cpu_signature
+
+    models = args.models or list(
+        dict.fromkeys(m for models in language_to_models.values() for m in models)
+    )
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        inputs = [
+            args.filename if n == 1 else make_long_input(args.filename, n, Path(tmp))
+            for n in args.loops
+        ]
+        # One process per run, so that peak RSS is measured per model.
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            max_tasks_per_child=1,
+        ) as executor:
+            for repo_id in models:
+                for filename in inputs:
+                    try:
+                        r = executor.submit(_run_one, repo_id, filename).result()
+                    except Exception as e:
+                        print(f"{repo_id} on {filename} failed: {e}", file=sys.stderr)
+                        continue
+                    print(
+                        f"{r['model']:>60} {r['input']:>20} RTF={r['rtf']:.4f} "
+                        f"peak RSS={r['peak_rss_bytes'] / 2**20:.0f} MiB "
+                        + " ".join(f"{s}={r['stages'][s]:.2f}s" for s in stages)
+                    )
+                    results.append(r)
+
+    with open(args.output, "w") as f:
+        json.dump({"host": cpu_signature(), "runs": results}, f, indent=2)
+    print(f"Wrote {args.output}")
+
+
+def _metrics(run: Dict) -> Dict[str, float]:
+    metrics = {"rtf": run["rtf"], "peak_rss_bytes": run["peak_rss_bytes"]}
+    for s in stages:
+        metrics[f"{s}_seconds"] = run["stages"][s]
+    return metrics
+
+
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+
+    if baseline["host"] != results["host"]:
+        print(
+            "Warning: results are from different hosts:\n"
+            f"  {baseline['host']}\n  {results['host']}"
+        )
+
+    old_runs = {(r["model"], r["input"]): r for r in baseline["runs"]}
+
+    regressions: List[str] = []
+    for r in results["runs"]:
+        old = old_runs.get((r["model"], r["input"]))
+        if old is None:
+            continue
+
+        old_metrics = _metrics(old)
+        for name, value in _metrics(r).items():
+            old_value = old_metrics[name]
+            # Ignore stages too short to be timed reliably.
+            if name.endswith("_seconds") and value - old_value < args.min_seconds:
+                continue
+            if value > old_value * (1 + args.threshold):
+                change = value / old_value - 1 if old_value else float("inf")
+                regressions.append(
+                    f"{r['model']} on {r['input']}: {name} "
+                    f"{old_value:.4g} -> {value:.4g} (+{change:.0%})"
+                )
+
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--models", nargs="+")
+    run_parser.add_argument("--filename", default="example.mp4")
+    run_parser.add_argument("--loops", nargs="+", type=int, default=[1, 8])
+    run_parser.add_argument("-o", "--output", default="bench_results.json")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    compare_parser.add_argument("--min-seconds", type=float, default=0.05)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
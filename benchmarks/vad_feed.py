@@ -0,0 +1,71 @@
+"""Measure how fast decode.VadFeeder pushes audio into the VAD.
+
+Usage (from the repository root):
+
+    python -m benchmarks.vad_feed [--filename example.mp4] [--repeat 5]
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+
+from audio_source import read_pcm
+from decode import VadFeeder
+from model import create_vad, sample_rate
+
+
+def feed_concatenate(vad, data: bytes, frames_per_read: int, window_size: int = 512):
+    # The implementation decode.decode used before VadFeeder, kept for comparison.
+    f = io.BytesIO(data)
+    buffer = []
+    while True:
+        chunk = f.read(frames_per_read * 2)
+        if not chunk:
+            break
+        samples = np.frombuffer(chunk, dtype=np.int16)
+        samples = samples.astype(np.float32) / 32768
+
+        buffer = np.concatenate([buffer, samples])
+        while len(buffer) > window_size:
+            vad.accept_waveform(buffer[:window_size])
+            buffer = buffer[window_size:]
+
+
+def feed_ring_buffer(vad, data: bytes, frames_per_read: int):
+    f = io.BytesIO(data)
+    feeder = VadFeeder(vad, frames_per_read)
+    while feeder.read_from(f):
+        pass
+
+
+def run(name, fn, vad, data, frames_per_read, repeat):
+    num_samples = len(data) // 2
+    best = float("inf")
+    for _ in range(repeat):
+        vad.reset()
+        start = time.perf_counter()
+        fn(vad, data, frames_per_read)
+        best = min(best, time.perf_counter() - start)
+        while not vad.empty():
+            vad.pop()
+    print(f"{name:>12}: {num_samples / best:,.0f} samples/sec ({best:.3f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filename", default="example.mp4")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    data = read_pcm(args.filename)
+    frames_per_read = int(sample_rate * 100)  # same as decode.decode
+    vad = create_vad()
+
+    print(f"{args.filename}: {len(data) // 2 / sample_rate:.1f} s of audio")
+    run("concatenate", feed_concatenate, vad, data, frames_per_read, args.repeat)
+    run("ring buffer", feed_ring_buffer, vad, data, frames_per_read, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
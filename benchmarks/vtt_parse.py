@@ -0,0 +1,90 @@
+"""Compare utils.vtt_string_to_dataframe with the webvtt-py based parser it
+replaced.
+
+Usage (from the repository root):
+
+    python -m benchmarks.vtt_parse [--cues 20000] [--repeat 3]
+"""
+import argparse
+import io
+import time
+
+import pandas as pd
+import webvtt
+
+from utils import string_to_time, time_to_webvtt_timestamp, vtt_string_to_dataframe
+
+
+def legacy_vtt_string_to_dataframe(vtt_string: str) -> pd.DataFrame:
+    time_epsilon = pd.Timedelta("00:00:00.1")
+
+    buffer = io.StringIO(vtt_string)
+
+    vtt = webvtt.read_buffer(buffer=buffer)
+
+    df = pd.DataFrame(
+        [
+            [
+                pd.to_datetime(v.start),
+                pd.to_datetime(v.end),
+                v.text.splitlines()[-1],
+            ]
+            for v in vtt
+        ],
+        columns=["start", "end", "text"],
+    )
+    df = df.where(df.end - df.start > time_epsilon).dropna()
+    df["start"] = df["start"].apply(time_to_webvtt_timestamp)
+    df["end"] = df["end"].apply(time_to_webvtt_timestamp)
+    df["start"] = df["start"].apply(string_to_time)
+    df["end"] = df["end"].apply(string_to_time)
+    return df
+
+
+def _timestamp(ms: int) -> str:
+    return (
+        f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}"
+        f".{ms % 1000:03d}"
+    )
+
+
+def make_vtt(num_cues: int) -> str:
+    lines = ["WEBVTT", ""]
+    for i in range(num_cues):
+        start = i * 2500 + 125
+        lines += [
+            str(i + 1),
+            f"{_timestamp(start)} --> {_timestamp(start + 2000)}",
+            f"subtitle number {i + 1}",
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def best_of(fn, arg, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cues", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    vtt = make_vtt(args.cues)
+
+    legacy = best_of(legacy_vtt_string_to_dataframe, vtt, args.repeat)
+    vectorized = best_of(vtt_string_to_dataframe, vtt, args.repeat)
+
+    print(f"{args.cues} cues")
+    print(f"    webvtt-py: {legacy:.3f} s")
+    print(f"   vectorized: {vectorized:.3f} s ({legacy / vectorized:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
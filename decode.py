@@ -1,11 +1,33 @@
+import io
 import logging
-import subprocess
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import timedelta
+from typing import BinaryIO, Callable, Iterator, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import sherpa_onnx
-from model import sample_rate
+
+import metrics
+from audio_source import PcmSource, open_pcm
+from model import sample_rate, vad_max_segment_duration
+from segment_table import SegmentTable
+from subtitle_writer import format_timestamp, seconds_to_ms
+
+# Bump whenever a change here alters the produced segments, so that cached
+# transcripts from older versions are not reused.
+decoder_version = 1
+
+# A segment longer than the maximum segment duration is cut at the quietest
+# split_frame_seconds frame of the last split_search_seconds before the limit.
+split_search_seconds = 2.0
+split_frame_seconds = 0.02
+
+# Upper bounds in seconds of the duration buckets. A decode_streams() call
+# only gets segments from one bucket, so that short segments are not padded
+# to the length of long ones.
+duration_buckets = (2.0, 5.0, 10.0, 20.0)
 
 
 @dataclass
@@ -19,84 +41,427 @@ class Segment:
         return self.start + self.duration
 
     def __str__(self):
-        s = f"0{timedelta(seconds=self.start)}"[:-3]
+        s = format_timestamp(seconds_to_ms(self.start), ",")
         s += " --> "
-        s += f"0{timedelta(seconds=self.end)}"[:-3]
-        s = s.replace(".", ",")
+        s += format_timestamp(seconds_to_ms(self.end), ",")
         s += "\n"
         s += self.text
         return s
 
 
-def decode(
-    recognizer: sherpa_onnx.OfflineRecognizer,
-    vad: sherpa_onnx.VoiceActivityDetector,
-    filename: str,
-) -> str:
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-i",
-        filename,
-        "-f",
-        "s16le",
-        "-acodec",
-        "pcm_s16le",
-        "-ac",
-        "1",
-        "-ar",
-        str(sample_rate),
-        "-",
-    ]
-
-    process = subprocess.Popen(
-        ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
-    )
+class VadFeeder:
+    """Feed 16-bit PCM to a VAD in fixed-size windows.
 
-    frames_per_read = int(sample_rate * 100)  # 100 second
+    Samples are converted to float32 in place into one preallocated buffer and
+    the VAD is fed views of it, so no arrays are allocated per window.
+    """
 
-    window_size = 512
+    def __init__(
+        self,
+        vad: sherpa_onnx.VoiceActivityDetector,
+        frames_per_read: int,
+        window_size: int = 512,
+    ):
+        self.vad = vad
+        self.window_size = window_size
+        self._pcm = np.empty(frames_per_read, dtype=np.int16)
+        self._pcm_bytes = memoryview(self._pcm).cast("B")
+        # At most window_size samples are carried over between reads.
+        self._buffer = np.empty(frames_per_read + window_size, dtype=np.float32)
+        self._size = 0
 
-    buffer = []
+    def read_from(self, f) -> int:
+        """Read up to frames_per_read samples of s16le PCM from f and feed them.
 
-    segment_list = []
+        Returns the number of bytes read, 0 at end of stream.
+        """
+        samples = self.read(f)
+        self.feed(samples)
+        return samples.nbytes
 
-    logging.info("Started!")
+    def read(self, f) -> np.ndarray:
+        """Read up to frames_per_read samples of s16le PCM from f.
+
+        The result is a view that is only valid until the next read.
+        """
+        num_bytes = 0
+        while num_bytes < len(self._pcm_bytes):
+            n = f.readinto(self._pcm_bytes[num_bytes:])
+            if not n:
+                break
+            num_bytes += n
 
-    while True:
         # *2 because int16_t has two bytes
-        data = process.stdout.read(frames_per_read * 2)
-        if not data:
-            break
-
-        samples = np.frombuffer(data, dtype=np.int16)
-        samples = samples.astype(np.float32) / 32768
-
-        buffer = np.concatenate([buffer, samples])
-        while len(buffer) > window_size:
-            vad.accept_waveform(buffer[:window_size])
-            buffer = buffer[window_size:]
-
-        streams = []
-        segments = []
-        while not vad.empty():
-            segment = Segment(
-                start=vad.front.start / sample_rate,
-                duration=len(vad.front.samples) / sample_rate,
+        return self._pcm[: num_bytes // 2]
+
+    def feed(self, samples: np.ndarray) -> int:
+        """Feed samples to the VAD, returns the number of windows fed."""
+        start = self._size
+        end = start + len(samples)
+        np.multiply(samples, np.float32(1 / 32768), out=self._buffer[start:end])
+
+        window_size = self.window_size
+        pos = 0
+        while end - pos > window_size:
+            self.vad.accept_waveform(self._buffer[pos : pos + window_size])
+            pos += window_size
+
+        self._size = end - pos
+        self._buffer[: self._size] = self._buffer[pos:end]
+        return pos // window_size
+
+
+def split_segment(
+    segment: Segment,
+    samples: Sequence[float],
+    max_duration: float = vad_max_segment_duration,
+) -> Tuple[List[Segment], List[Sequence[float]]]:
+    """Split segment into pieces of at most max_duration seconds.
+
+    Each cut is placed at the lowest-energy frame shortly before the limit,
+    which usually is a pause between words. Returns the pieces and their
+    samples; a segment that is short enough is returned as it is. Limits
+    below two frames (2 * split_frame_seconds) are raised to that.
+    """
+    max_samples = int(max_duration * sample_rate)
+    if not max_duration or len(samples) <= max_samples:
+        return [segment], [samples]
+
+    samples = np.asarray(samples, dtype=np.float32)
+    frame = int(split_frame_seconds * sample_rate)
+    # Pieces are at least two frames long, so that there is a frame to cut
+    # at however small max_duration is.
+    max_samples = max(max_samples, 2 * frame)
+    search = min(int(split_search_seconds * sample_rate), max_samples // 2)
+    num_frames = search // frame
+
+    cuts = [0]
+    while len(samples) - cuts[-1] > max_samples:
+        first = cuts[-1] + max_samples - num_frames * frame
+        frames = samples[first : first + num_frames * frame].reshape(num_frames, frame)
+        energy = np.einsum("ij,ij->i", frames, frames)
+        cuts.append(first + int(np.argmin(energy)) * frame + frame // 2)
+    cuts.append(len(samples))
+
+    segments = []
+    pieces = []
+    for begin, end in zip(cuts, cuts[1:]):
+        segments.append(
+            Segment(
+                start=segment.start + begin / sample_rate,
+                duration=(end - begin) / sample_rate,
             )
-            segments.append(segment)
+        )
+        pieces.append(samples[begin:end])
+    return segments, pieces
+
+
+def _pop_segments(
+    vad: sherpa_onnx.VoiceActivityDetector,
+    offset: float = 0,
+    max_segment_duration: float = vad_max_segment_duration,
+) -> Tuple[List[Segment], List[Sequence[float]]]:
+    """Pop the finished segments off vad, split to max_segment_duration."""
+    segments = []
+    samples_list = []
+    while not vad.empty():
+        front = vad.front
+        segment = Segment(
+            start=offset + front.start / sample_rate,
+            duration=len(front.samples) / sample_rate,
+        )
+        pieces, pieces_samples = split_segment(
+            segment, front.samples, max_segment_duration
+        )
+        segments.extend(pieces)
+        samples_list.extend(pieces_samples)
+        vad.pop()
+    return segments, samples_list
+
+
+def _read_windows(source: PcmSource) -> Iterator[np.ndarray]:
+    while True:
+        samples = source.read()
+        if not len(samples):
+            return
+        yield samples
+
+
+def vad_split(
+    vad: sherpa_onnx.VoiceActivityDetector,
+    data: bytes,
+    max_segment_duration: float = vad_max_segment_duration,
+) -> Tuple[List[Segment], List[Sequence[float]]]:
+    """Run the VAD over in-memory s16le PCM and return the unrecognized
+    segments together with their samples."""
+    feeder = VadFeeder(vad, int(sample_rate * 100))
+    f = io.BytesIO(data)
+    while feeder.read_from(f):
+        pass
+
+    return _pop_segments(vad, 0, max_segment_duration)
+
+
+def duration_batches(
+    samples: Sequence[Sequence[float]],
+    max_batch_size: Optional[int] = None,
+    buckets: Optional[Sequence[float]] = duration_buckets,
+) -> List[List[int]]:
+    """Group the indices of samples into batches for decode_streams().
+
+    The indices are sorted by duration and each batch holds segments of one
+    duration bucket only, and at most max_batch_size of them. With buckets
+    None, batches are taken in the original order.
+    """
+    order = range(len(samples))
+    if buckets is not None:
+        order = sorted(order, key=lambda i: len(samples[i]))
+
+    batches = []
+    batch = []
+    batch_bucket = None
+    for i in order:
+        bucket = 0
+        if buckets is not None:
+            bucket = bisect_left(buckets, len(samples[i]) / sample_rate)
+        if batch and (bucket != batch_bucket or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+        batch_bucket = bucket
+    if batch:
+        batches.append(batch)
+    return batches
 
-            stream = recognizer.create_stream()
-            stream.accept_waveform(sample_rate, vad.front.samples)
 
-            streams.append(stream)
+def _decode_batch(
+    recognizer: sherpa_onnx.OfflineRecognizer,
+    segments: List[Segment],
+    samples: Sequence[Sequence[float]],
+    max_batch_size: Optional[int] = None,
+    run: metrics.Run = metrics.null_run,
+    submitted: Optional[float] = None,
+    buckets: Optional[Sequence[float]] = duration_buckets,
+):
+    if not segments:
+        return
+
+    started = time.perf_counter()
+    if submitted is not None:
+        run.observe("recognizer_queue_wait_seconds", started - submitted)
+
+    streams = []
+    for s in samples:
+        stream = recognizer.create_stream()
+        stream.accept_waveform(sample_rate, s)
+        streams.append(stream)
+
+    for batch in duration_batches(samples, max_batch_size, buckets):
+        recognizer.decode_streams([streams[i] for i in batch])
+        # Each stream of a batch is padded to the longest one.
+        lengths = [len(samples[i]) for i in batch]
+        padding = max(lengths) * len(lengths) - sum(lengths)
+        run.add("padding_seconds", padding / sample_rate)
+
+    for seg, stream in zip(segments, streams):
+        seg.text = stream.result.text.strip()
+
+    # Every segment of a batch waits for the whole batch.
+    elapsed = time.perf_counter() - started
+    run.add("asr_seconds", elapsed)
+    run.observe("asr_latency_seconds", elapsed, len(segments))
+
+
+def vad_windows(
+    vad: sherpa_onnx.VoiceActivityDetector,
+    filename: Union[str, np.ndarray],
+    seconds_per_read: float = 100,
+    start: float = 0,
+    duration: Optional[float] = None,
+    run: metrics.Run = metrics.null_run,
+    pcm_out: Optional[BinaryIO] = None,
+) -> Iterator[Tuple[float, List[Segment], List[Sequence[float]]]]:
+    """Split filename into speech segments, one read window at a time.
+
+    Yields the position in seconds up to which the file has been read, and
+    the unrecognized segments that ended in that window with their samples.
+    Segments longer than model.vad_max_segment_duration are split.
+    See decode_segments() for the arguments.
+    """
+    frames_per_read = int(sample_rate * seconds_per_read)
+
+    feeder = VadFeeder(vad, frames_per_read)
+    num_samples = 0
+
+    source: Optional[PcmSource] = None
+    if isinstance(filename, np.ndarray):
+        read_stage = "pcm_read"
+        first = int(start * sample_rate)
+        last = len(filename)
+        if duration is not None:
+            last = min(last, first + int(duration * sample_rate))
+        windows = (
+            filename[i : min(i + frames_per_read, last)]
+            for i in range(first, last, frames_per_read)
+        )
+    else:
+        source = open_pcm(filename, start, duration, frames_per_read)
+        read_stage = source.name
+        windows = _read_windows(source)
+
+    logging.info("Started!")
+
+    try:
+        while True:
+            with run.time(read_stage):
+                samples = next(windows, None)
+            if samples is None:
+                break
+            run.add("bytes_read", samples.nbytes)
+            num_samples += len(samples)
+            if pcm_out is not None and source is not None:
+                pcm_out.write(samples)
+
+            with run.time("vad"):
+                run.add("vad_windows", feeder.feed(samples))
+
+            segments, samples_list = _pop_segments(vad, start)
+
+            run.add("segments", len(segments))
+            for seg in segments:
+                run.observe("segment_duration_seconds", seg.duration)
 
-            vad.pop()
+            yield start + num_samples / sample_rate, segments, samples_list
+    finally:
+        # Also reached when the caller stops iterating early.
+        if source is not None:
+            source.close()
 
-        for s in streams:
-            recognizer.decode_stream(s)
 
-        for seg, stream in zip(segments, streams):
-            seg.text = stream.result.text.strip()
-            segment_list.append(seg)
+def decode_segments(
+    recognizer: Union[
+        sherpa_onnx.OfflineRecognizer, Sequence[sherpa_onnx.OfflineRecognizer]
+    ],
+    vad: sherpa_onnx.VoiceActivityDetector,
+    filename: Union[str, np.ndarray],
+    seconds_per_read: float = 100,
+    start: float = 0,
+    duration: Optional[float] = None,
+    max_batch_size: Optional[int] = None,
+    run: Optional[metrics.Run] = None,
+    on_progress: Optional[Callable[[float], None]] = None,
+    pcm_out: Optional[BinaryIO] = None,
+    max_seconds_per_decode: float = 100,
+) -> Iterator[Segment]:
+    """Yield recognized segments of filename in order, as soon as they are ready.
+
+    recognizer may be a single recognizer or a pool of independent instances
+    of the same model (see model.checkout_recognizers). The segments of each
+    read window are decoded together, split evenly across the pool, in
+    batches of segments of similar duration (see duration_batches()).
+    The first segments are decoded after seconds_per_read, later ones in
+    windows that double in length up to max_seconds_per_decode, so that a
+    small seconds_per_read gives early results without keeping the batches
+    small for the rest of the file.
+    start and duration (in seconds) restrict decoding to a part of the file;
+    segment timestamps are always relative to the start of the file.
+    max_batch_size limits the number of segments per decode_streams call.
+    Timings and counters go to run, or to a run of its own if it is None.
+    on_progress is called after each decode with the position in seconds up
+    to which the file has been decoded.
+
+    Instead of a file name, filename may be the file's audio as 16 kHz mono
+    int16 samples, e.g. a memory map from pcm_cache, which skips ffmpeg.
+    Otherwise the samples ffmpeg produces are also written to pcm_out, if
+    given.
+    """
+    own_run = run is None
+    if own_run:
+        run = metrics.start_run("decode")
+
+    if isinstance(recognizer, sherpa_onnx.OfflineRecognizer):
+        recognizers = [recognizer]
+    else:
+        recognizers = list(recognizer)
+
+    executor = None
+    if len(recognizers) > 1:
+        executor = ThreadPoolExecutor(max_workers=len(recognizers))
+
+    windows = vad_windows(
+        vad, filename, seconds_per_read, start, duration, run, pcm_out
+    )
+
+    def decode_window(segments, samples_list):
+        if executor is None:
+            _decode_batch(recognizers[0], segments, samples_list, max_batch_size, run)
+            return
+        # Deal the segments out by duration, so that every recognizer gets a
+        # similar share of short and long ones.
+        n = len(recognizers)
+        order = sorted(range(len(segments)), key=lambda i: len(samples_list[i]))
+        futures = [
+            executor.submit(
+                _decode_batch,
+                r,
+                [segments[j] for j in order[i::n]],
+                [samples_list[j] for j in order[i::n]],
+                max_batch_size,
+                run,
+                time.perf_counter(),
+            )
+            for i, r in enumerate(recognizers)
+        ]
+        for f in futures:
+            f.result()
 
-    return "\n\n".join(f"{i}\n{seg}" for i, seg in enumerate(segment_list, 1))
\ No newline at end of file
+    # Segments are decoded once decode_seconds of audio were read since the
+    # last decode. It starts at seconds_per_read and doubles up to
+    # max_seconds_per_decode, so that the first results come early and the
+    # later batches are large.
+    decode_seconds = seconds_per_read
+    decoded_to = position = start
+    pending_segments: List[Segment] = []
+    pending_samples: List[Sequence[float]] = []
+    try:
+        for position, segments, samples_list in windows:
+            pending_segments += segments
+            pending_samples += samples_list
+            # Window ends are rounded to whole samples.
+            if position - decoded_to + 1 / sample_rate < decode_seconds:
+                continue
+
+            decode_window(pending_segments, pending_samples)
+            if on_progress is not None:
+                on_progress(position)
+            yield from pending_segments
+            pending_segments, pending_samples = [], []
+            decoded_to = position
+            decode_seconds = min(
+                decode_seconds * 2, max(seconds_per_read, max_seconds_per_decode)
+            )
+
+        if decoded_to < position or pending_segments:
+            decode_window(pending_segments, pending_samples)
+            if on_progress is not None:
+                on_progress(position)
+            yield from pending_segments
+    finally:
+        # Also reached when the caller stops iterating early.
+        windows.close()
+        if executor is not None:
+            executor.shutdown()
+        if own_run:
+            run.finish()
+
+
+def decode(
+    recognizer: Union[
+        sherpa_onnx.OfflineRecognizer, Sequence[sherpa_onnx.OfflineRecognizer]
+    ],
+    vad: sherpa_onnx.VoiceActivityDetector,
+    filename: str,
+) -> str:
+    """Generate SRT subtitles for filename. See decode_segments()."""
+    segments = decode_segments(recognizer, vad, filename)
+    return SegmentTable.from_segments(segments).to_srt()
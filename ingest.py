@@ -0,0 +1,143 @@
+"""Bring uploaded media onto disk once, hashing it on the way.
+
+An upload is read once in large chunks. Each chunk is fed to SHA-256 and
+written to a temporary file, which is then renamed after its hash. ffmpeg and
+the caches downstream get that path and hash, so reruns of a page and
+repeated uploads of the same content neither read nor copy the file again.
+Spooled files are deleted once they have not been used for
+SUBTITLE_UPLOAD_TTL seconds.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Optional, Tuple
+
+from paths import cache_dir
+
+upload_dir = cache_dir / "uploads"
+
+upload_ttl = int(os.environ.get("SUBTITLE_UPLOAD_TTL", 24 * 3600))
+
+chunk_size = 8 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class IngestedFile:
+    path: str
+    sha256: str
+    size: int
+
+
+def _copy_and_hash(
+    src: BinaryIO, dst: BinaryIO, limit: Optional[int] = None
+) -> Tuple[str, int]:
+    sha256 = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    while limit is None or size < limit:
+        if limit is None or limit - size >= chunk_size:
+            n = src.readinto(buffer)
+        else:
+            n = src.readinto(view[: limit - size])
+        if not n:
+            break
+        sha256.update(view[:n])
+        dst.write(view[:n])
+        size += n
+    return sha256.hexdigest(), size
+
+
+def spool(
+    fileobj: BinaryIO, suffix: str = "", size: Optional[int] = None
+) -> IngestedFile:
+    """Write fileobj to upload_dir under its SHA-256, reading it once.
+
+    Without size, fileobj is read from the start to the end and rewound.
+    With size, exactly that many bytes are read from where it stands, e.g.
+    from the body of an HTTP request.
+    """
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    if size is None:
+        fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(dir=upload_dir, suffix=".tmp", delete=False) as f:
+        try:
+            sha256, num_bytes = _copy_and_hash(fileobj, f, size)
+            if size is not None and num_bytes < size:
+                raise EOFError(f"Expected {size} bytes, got {num_bytes}")
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    if size is None:
+        fileobj.seek(0)
+
+    path = upload_dir / f"{sha256}{suffix}"
+    if path.exists():
+        # Same content seen before; keep the file jobs may be reading.
+        os.unlink(f.name)
+        os.utime(path)
+    else:
+        os.replace(f.name, path)
+    return IngestedFile(str(path), sha256, num_bytes)
+
+
+_lock = threading.Lock()
+_by_upload: Dict[str, IngestedFile] = {}
+_by_path: Dict[Tuple[str, int, int], IngestedFile] = {}
+
+
+def ingest_upload(uploaded_file) -> IngestedFile:
+    """Spool a Streamlit UploadedFile, once per upload."""
+    with _lock:
+        ingested = _by_upload.get(uploaded_file.file_id)
+    if ingested is not None and os.path.exists(ingested.path):
+        return ingested
+
+    remove_stale_uploads()
+    ingested = spool(uploaded_file, Path(uploaded_file.name).suffix)
+    with _lock:
+        _by_upload[uploaded_file.file_id] = ingested
+    return ingested
+
+
+def ingest_path(path: str) -> IngestedFile:
+    """Hash a file that is already on disk, once per size and mtime."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        ingested = _by_path.get(key)
+    if ingested is not None:
+        return ingested
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    ingested = IngestedFile(path, sha256.hexdigest(), stat.st_size)
+    with _lock:
+        _by_path[key] = ingested
+    return ingested
+
+
+def remove_stale_uploads():
+    if not upload_dir.exists():
+        return
+    now = time.time()
+    for path in upload_dir.iterdir():
+        try:
+            if now - path.stat().st_mtime > upload_ttl:
+                path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logging.exception(f"Failed to remove {path}")
+
+    with _lock:
+        for upload_id, ingested in list(_by_upload.items()):
+            if not os.path.exists(ingested.path):
+                del _by_upload[upload_id]
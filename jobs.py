@@ -0,0 +1,305 @@
+"""Run transcriptions in the background.
+
+Pages submit a job and poll its state on every rerun instead of decoding in
+the script thread, so the work goes on when the script is rerun or the user
+navigates away. Jobs run on a pool of SUBTITLE_JOB_WORKERS threads, and at
+most SUBTITLE_JOBS_PER_MODEL jobs use the same model at a time, so that one
+popular model does not hold all workers. Queued jobs are started round robin
+across sessions, so a session that queues many files does not hold up the
+others.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional
+
+import metrics
+from decode import Segment, decode_segments
+from model import checkout_recognizers, checkout_vad, session_options
+from pcm_cache import get_pcm_cache
+from segment_table import SegmentTable
+from transcript_cache import get_transcript_cache
+
+max_workers = int(os.environ.get("SUBTITLE_JOB_WORKERS", "2"))
+jobs_per_model = int(os.environ.get("SUBTITLE_JOBS_PER_MODEL", "1"))
+
+# Finished jobs are forgotten after this many seconds.
+job_ttl = 3600
+
+# Decode the first few seconds on their own so the first subtitles show up
+# soon; later windows double in length, see decode_segments().
+seconds_per_read = 2
+
+
+@dataclass
+class Job:
+    id: str
+    session_id: str
+    repo_id: str
+    filename: str
+    file_hash: Optional[str] = None
+    # Length of the audio in seconds, if known.
+    duration: Optional[float] = None
+    # One of queued, running, done, failed and cancelled.
+    state: str = "queued"
+    # Seconds of audio decoded so far.
+    progress: float = 0.0
+    segments: List[Segment] = field(default_factory=list)
+    result: Optional[SegmentTable] = None
+    error: Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    finished: Optional[float] = None
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    @property
+    def fraction(self) -> float:
+        if self.state == "done":
+            return 1.0
+        if not self.duration:
+            return 0.0
+        return min(1.0, self.progress / self.duration)
+
+
+def transcribe(job: Job) -> Optional[SegmentTable]:
+    """Decode job.filename with job.repo_id, or return None if cancelled."""
+    run = metrics.start_run("process", model=job.repo_id)
+
+    transcript_cache = get_transcript_cache()
+    table = None
+    if job.file_hash:
+        table = transcript_cache.get(job.file_hash, job.repo_id)
+
+    if table is not None:
+        logging.info(f"Using cached transcript for {job.filename}")
+        run.add("transcript_cache_hits")
+    else:
+        table = _decode(job, run)
+        if table is None:
+            run.finish()
+            return None
+
+        if job.file_hash:
+            transcript_cache.put(job.file_hash, job.repo_id, table)
+
+    run.finish()
+    return table
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def _decode(job: Job, run: metrics.Run) -> Optional[SegmentTable]:
+    def on_progress(seconds):
+        job.progress = seconds
+        # Stops after each read window, also in long stretches without
+        # speech that yield no segments.
+        if job.cancel_event.is_set():
+            raise _Cancelled()
+
+    with ExitStack() as stack:
+        # Waits while other jobs use all recognizers of the model.
+        with run.time("model_load"):
+            recognizers = stack.enter_context(checkout_recognizers(job.repo_id))
+            vad = stack.enter_context(checkout_vad())
+
+        # With a file hash, the audio is decoded by ffmpeg once and read
+        # from the PCM cache by every later job on the same file.
+        source = job.filename
+        pcm_out = None
+        if job.file_hash:
+            pcm = get_pcm_cache().get(job.file_hash)
+            if pcm is not None:
+                source = pcm
+                run.add("pcm_cache_hits")
+            else:
+                pcm_out = stack.enter_context(get_pcm_cache().writer(job.file_hash))
+
+        segments = decode_segments(
+            recognizers,
+            vad,
+            source,
+            seconds_per_read=seconds_per_read,
+            max_batch_size=session_options.get(job.repo_id).batch_size,
+            run=run,
+            on_progress=on_progress,
+            pcm_out=pcm_out,
+        )
+        try:
+            for segment in segments:
+                if job.cancel_event.is_set():
+                    raise _Cancelled()
+                job.segments.append(segment)
+        except _Cancelled:
+            # Closing the generator stops ffmpeg.
+            segments.close()
+            return None
+
+        if pcm_out is not None:
+            pcm_out.commit()
+
+    return SegmentTable.from_segments(job.segments)
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        run_job: Callable[[Job], Optional[SegmentTable]],
+        max_workers: int,
+        jobs_per_model: int,
+    ):
+        self._run_job = run_job
+        self.max_workers = max(1, max_workers)
+        self.jobs_per_model = max(1, jobs_per_model)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="transcribe"
+        )
+
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._queues: Dict[str, Deque[Job]] = {}
+        # When each session last started a job. Sessions that waited longest,
+        # or never started one, go first.
+        self._last_turn: Dict[str, int] = {}
+        self._turn = 0
+        self._running: Dict[str, int] = defaultdict(int)
+        self._num_running = 0
+
+    def submit(
+        self,
+        session_id: str,
+        repo_id: str,
+        filename: str,
+        file_hash: Optional[str] = None,
+        duration: Optional[float] = None,
+    ) -> str:
+        job = Job(uuid.uuid4().hex, session_id, repo_id, filename, file_hash, duration)
+        with self._lock:
+            self._forget_finished()
+            self._jobs[job.id] = job
+            self._queues.setdefault(session_id, deque()).append(job)
+            self._dispatch()
+        return job.id
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: Optional[str]):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return
+            job.cancel_event.set()
+            if job.state == "queued":
+                queue = self._queues[job.session_id]
+                queue.remove(job)
+                if not queue:
+                    del self._queues[job.session_id]
+                job.state = "cancelled"
+                job.finished = time.time()
+
+    def position(self, job_id: str) -> int:
+        """Number of queued jobs that start before job_id, ignoring the
+        per-model limit."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.state != "queued":
+                return 0
+            index = self._queues[job.session_id].index(job)
+            # Each round, every session in line starts one of its jobs.
+            ahead = 0
+            before = True
+            for session_id in self._sessions_in_line():
+                if session_id == job.session_id:
+                    before = False
+                    ahead += index
+                else:
+                    ahead += min(len(self._queues[session_id]), index + before)
+            return ahead
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "running": self._num_running,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "running_per_model": {k: v for k, v in self._running.items() if v},
+            }
+
+    def _dispatch(self):
+        # Called with the lock held.
+        while self._num_running < self.max_workers:
+            job = self._next_job()
+            if job is None:
+                return
+            job.state = "running"
+            self._running[job.repo_id] += 1
+            self._num_running += 1
+            self._executor.submit(self._run, job)
+
+    def _sessions_in_line(self) -> List[str]:
+        return sorted(self._queues, key=lambda s: self._last_turn.get(s, -1))
+
+    def _next_job(self) -> Optional[Job]:
+        # The first session in line with a job whose model has a free slot
+        # starts it and moves to the back of the line.
+        for session_id in self._sessions_in_line():
+            queue = self._queues[session_id]
+            for job in queue:
+                if self._running[job.repo_id] < self.jobs_per_model:
+                    queue.remove(job)
+                    if not queue:
+                        del self._queues[session_id]
+                    self._last_turn[session_id] = self._turn
+                    self._turn += 1
+                    return job
+        return None
+
+    def _run(self, job: Job):
+        result = None
+        error = None
+        try:
+            result = self._run_job(job)
+        except Exception as e:
+            logging.exception(f"Job {job.id} failed")
+            error = str(e)
+
+        with self._lock:
+            job.result = result
+            job.error = error
+            if error is not None:
+                job.state = "failed"
+            elif job.cancel_event.is_set():
+                job.state = "cancelled"
+            else:
+                job.state = "done"
+            job.finished = time.time()
+            self._running[job.repo_id] -= 1
+            self._num_running -= 1
+            self._dispatch()
+
+    def _forget_finished(self):
+        now = time.time()
+        for job_id in [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.done and now - job.finished > job_ttl
+        ]:
+            del self._jobs[job_id]
+        active = {job.session_id for job in self._jobs.values()}
+        for session_id in list(self._last_turn):
+            if session_id not in active:
+                del self._last_turn[session_id]
+
+
+scheduler = JobScheduler(transcribe, max_workers, jobs_per_model)
@@ -0,0 +1,386 @@
+"""Live captions with streaming models, for audio that is still arriving.
+
+Usage:
+
+    python live.py [--model csukuangfj/sherpa-onnx-streaming-zipformer-en-2023-06-26]
+        [--chunk-seconds 0.2] [--raw] [--realtime] [-o captions.vtt] SOURCE
+
+SOURCE is one of
+
+    a file that is still being written, e.g. a recording in progress; it is
+        followed until no new data arrived for idle_timeout seconds
+    "-" for stdin, or a named pipe
+    a local socket, unix:/path/to.sock or tcp://127.0.0.1:PORT?listen
+
+ffmpeg turns any format it can read as a stream into 16 kHz mono samples;
+with --raw, the input is taken to be 16 kHz mono s16le already. --realtime
+reads a finished file at its own pace, to try things out without a live
+input.
+
+Samples are read in chunks of --chunk-seconds and fed to a sherpa-onnx
+OnlineRecognizer as they arrive. After every chunk that changes the text,
+the current hypothesis is emitted as a partial caption. When the endpoint
+detector finds a pause (see model.live_endpoint_silence), the caption is
+final and the next one starts. Final captions are printed as SRT cues, the
+partial ones are shown on stderr.
+
+The delay of a caption is measured from the arrival of the audio of its
+earliest new word until the caption is emitted. The word's position in the
+audio comes from the model's token timestamps, so the delay includes the
+time the model held the word back, as well as the time its sample waited
+for the rest of the chunk and the time to decode. Its percentiles are
+printed at the end and compared with delay_target.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import sherpa_onnx
+
+import metrics
+from decode import Segment
+from model import live_models, sample_rate
+from segment_table import SegmentTable
+
+chunk_seconds = float(os.environ.get("SUBTITLE_LIVE_CHUNK_SECONDS", "0.2"))
+
+# Captions should appear within this many seconds of the speech.
+delay_target = float(os.environ.get("SUBTITLE_LIVE_DELAY_TARGET", "1.0"))
+
+# A growing file is considered finished after this many seconds without
+# new data.
+idle_timeout = 10
+
+
+def _parse_sources(spec: str) -> Dict[str, str]:
+    sources = {}
+    for item in spec.split(";"):
+        name, sep, source = item.partition("=")
+        if sep and name.strip() and source.strip():
+            sources[name.strip()] = source.strip()
+    return sources
+
+
+# The only sources the web page may open besides uploaded files, as
+# name=source pairs separated by ";", e.g.
+# "Studio=/srv/recordings/studio.ts;Mixer=unix:/run/mixer.sock". Anything
+# else, such as sockets, pipes and URLs, only the command line accepts.
+configured_sources = _parse_sources(os.environ.get("SUBTITLE_LIVE_SOURCES", ""))
+
+# Silence fed after the end of the input, so that the model emits the last
+# words.
+tail_padding_seconds = 0.5
+
+
+def ffmpeg_live_command(
+    source: str, raw: bool = False, realtime: bool = False, follow: bool = False
+) -> List[str]:
+    """ffmpeg arguments that write source as 16 kHz mono s16le to stdout,
+    as soon as it arrives."""
+    ffmpeg_cmd = ["ffmpeg"]
+    if source != "-":
+        ffmpeg_cmd.append("-nostdin")
+    # Start at once instead of buffering input to analyze it.
+    ffmpeg_cmd += ["-analyzeduration", "0"]
+    if raw:
+        # Without a small probesize, ffmpeg reads 5 MB of raw input before
+        # it writes anything.
+        ffmpeg_cmd += ["-probesize", "32"]
+        ffmpeg_cmd += ["-f", "s16le", "-ar", str(sample_rate), "-ac", "1"]
+    if realtime:
+        ffmpeg_cmd.append("-re")
+    if follow:
+        ffmpeg_cmd += ["-follow", "1", "-rw_timeout", str(int(idle_timeout * 1e6))]
+        source = f"file:{source}"
+    elif source == "-":
+        source = "pipe:0"
+    ffmpeg_cmd += [
+        "-i",
+        source,
+        "-f",
+        "s16le",
+        "-acodec",
+        "pcm_s16le",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        # Write every packet at once rather than in 32 KiB blocks, which
+        # would hold back a second of audio.
+        "-flush_packets",
+        "1",
+        "-",
+    ]
+    return ffmpeg_cmd
+
+
+def read_chunks(
+    source: str,
+    chunk_seconds: float = chunk_seconds,
+    raw: bool = False,
+    realtime: bool = False,
+    follow: Optional[bool] = None,
+) -> Iterator[np.ndarray]:
+    """Yield source in chunks of chunk_seconds of float32 samples, each as
+    soon as it is complete. Each chunk is only valid until the next one.
+
+    By default, a regular file is followed as it grows unless realtime is
+    set; see ffmpeg_live_command().
+    """
+    if follow is None:
+        follow = os.path.isfile(source) and not realtime
+
+    process = subprocess.Popen(
+        ffmpeg_live_command(source, raw, realtime, follow),
+        stdin=None if source == "-" else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        bufsize=0,
+    )
+
+    pcm = np.empty(max(1, int(chunk_seconds * sample_rate)), dtype=np.int16)
+    pcm_bytes = memoryview(pcm).cast("B")
+    samples = np.empty(len(pcm), dtype=np.float32)
+    try:
+        while True:
+            num_bytes = 0
+            while num_bytes < len(pcm_bytes):
+                n = process.stdout.readinto(pcm_bytes[num_bytes:])
+                if not n:
+                    break
+                num_bytes += n
+
+            # *2 because int16_t has two bytes
+            n = num_bytes // 2
+            if not n:
+                return
+            np.multiply(pcm[:n], np.float32(1 / 32768), out=samples[:n])
+            yield samples[:n]
+    finally:
+        # Also reached when the caller stops iterating early.
+        process.kill()
+        process.wait()
+
+
+@dataclass
+class Caption:
+    segment: Segment
+    # A final caption does not change any more; a partial one is replaced by
+    # the next caption.
+    final: bool
+    # Position in seconds of the earliest word that was not in the previous
+    # caption, or of the last word if there is none.
+    audio_time: float = 0.0
+    # Seconds from the arrival of the audio at audio_time to the caption, see
+    # captions().
+    delay: float = 0.0
+
+
+class LiveCaptioner:
+    """Turns audio into captions, one chunk at a time."""
+
+    def __init__(self, recognizer: sherpa_onnx.OnlineRecognizer):
+        self.recognizer = recognizer
+        self.stream = recognizer.create_stream()
+        self.num_samples = 0
+        # Where the current caption started and the last chunk began, in
+        # seconds.
+        self._start = 0.0
+        self._chunk_start = 0.0
+        self._text = ""
+        self._tokens: List[str] = []
+        # (end in seconds, perf_counter() time of arrival) of recent chunks.
+        self._arrivals = deque()
+
+    @property
+    def position(self) -> float:
+        return self.num_samples / sample_rate
+
+    def accept(
+        self, samples: np.ndarray, arrived: Optional[float] = None
+    ) -> Optional[Caption]:
+        """Decode samples, return a caption if the text changed or ended.
+
+        arrived is the time.perf_counter() at which the last of samples was
+        read, now by default.
+        """
+        self._chunk_start = self.position
+        self.stream.accept_waveform(sample_rate, samples)
+        self.num_samples += len(samples)
+        self._arrivals.append(
+            (self.position, time.perf_counter() if arrived is None else arrived)
+        )
+        return self._decode()
+
+    def arrival_time(self, audio_time: float) -> float:
+        """time.perf_counter() at which the audio at audio_time was read.
+
+        Samples are taken to arrive at a steady pace within a chunk, but not
+        before the previous chunk.
+        """
+        previous = None
+        for end, arrived in self._arrivals:
+            if end >= audio_time:
+                estimate = arrived - (end - audio_time)
+                return estimate if previous is None else max(previous, estimate)
+            previous = arrived
+        return previous if previous is not None else time.perf_counter()
+
+    def finish(self) -> Optional[Caption]:
+        """Decode the rest after the end of the input, return the last
+        caption if there is one."""
+        tail_padding = np.zeros(int(tail_padding_seconds * sample_rate), np.float32)
+        self.stream.accept_waveform(sample_rate, tail_padding)
+        self.stream.input_finished()
+        return self._decode(finished=True)
+
+    def _decode(self, finished: bool = False) -> Optional[Caption]:
+        recognizer = self.recognizer
+        while recognizer.is_ready(self.stream):
+            recognizer.decode_stream(self.stream)
+        result = recognizer.get_result_all(self.stream)
+        text = result.text.strip()
+
+        # Captions start with the chunk in which their first word appeared,
+        # not at the end of the pause before it.
+        if text and not self._text:
+            self._start = self._chunk_start
+        segment = Segment(self._start, self.position - self._start, text)
+
+        # The earliest token that is new since the last caption.
+        tokens = list(result.tokens)
+        new = 0
+        while (
+            new < min(len(tokens), len(self._tokens))
+            and tokens[new] == self._tokens[new]
+        ):
+            new += 1
+        timestamps = list(result.timestamps)
+        if timestamps:
+            audio_time = result.start_time + timestamps[min(new, len(timestamps) - 1)]
+            audio_time = min(audio_time, self.position)
+        else:
+            audio_time = self._chunk_start
+
+        if finished or recognizer.is_endpoint(self.stream):
+            recognizer.reset(self.stream)
+            self._text = ""
+            self._tokens = []
+            # The next caption only has audio from here on.
+            while len(self._arrivals) > 1:
+                self._arrivals.popleft()
+            return Caption(segment, True, audio_time) if text else None
+
+        if text == self._text:
+            return None
+        self._text = text
+        self._tokens = tokens
+        return Caption(segment, False, audio_time)
+
+def captions(
+    recognizer: sherpa_onnx.OnlineRecognizer,
+    source: str,
+    chunk_seconds: float = chunk_seconds,
+    raw: bool = False,
+    realtime: bool = False,
+    follow: Optional[bool] = None,
+    run: metrics.Run = metrics.null_run,
+) -> Iterator[Caption]:
+    """Yield partial and final captions of source as it arrives.
+
+    See read_chunks() for the arguments.
+    """
+    captioner = LiveCaptioner(recognizer)
+    chunks = read_chunks(source, chunk_seconds, raw, realtime, follow)
+
+    def decoded() -> Iterator[Optional[Caption]]:
+        for samples in chunks:
+            with run.time("asr"):
+                caption = captioner.accept(samples)
+            yield caption
+        yield captioner.finish()
+
+    try:
+        for caption in decoded():
+            if caption is not None:
+                caption.delay = time.perf_counter() - captioner.arrival_time(
+                    caption.audio_time
+                )
+                run.observe("caption_delay_seconds", caption.delay)
+                yield caption
+    finally:
+        # Also reached when the caller stops iterating early.
+        chunks.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("source")
+    parser.add_argument(
+        "--model", choices=list(live_models), default=next(iter(live_models))
+    )
+    parser.add_argument("--chunk-seconds", type=float, default=chunk_seconds)
+    parser.add_argument("--raw", action="store_true")
+    parser.add_argument("--realtime", action="store_true")
+    parser.add_argument("-o", "--output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from model import checkout_recognizers
+
+    finals: List[Segment] = []
+    delays: List[float] = []
+    run = metrics.start_run("live", model=args.model)
+    try:
+        with checkout_recognizers(args.model, 1) as (recognizer,):
+            for caption in captions(
+                recognizer,
+                args.source,
+                args.chunk_seconds,
+                args.raw,
+                args.realtime,
+                run=run,
+            ):
+                delays.append(caption.delay)
+                # Overwrite the partial caption on stderr.
+                print("\r\033[K", end="", file=sys.stderr)
+                if caption.final:
+                    finals.append(caption.segment)
+                    print(f"{len(finals)}\n{caption.segment}\n", flush=True)
+                else:
+                    print(caption.segment.text, end="", file=sys.stderr, flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        run.finish()
+
+    if args.output:
+        table = SegmentTable.from_segments(finals)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(table.to_srt() if args.output.endswith(".srt") else table.to_vtt())
+
+    if delays:
+        p50, p95 = np.percentile(delays, [50, 95])
+        print(
+            f"Caption delay p50={p50 * 1000:.0f} ms p95={p95 * 1000:.0f} ms "
+            f"max={max(delays) * 1000:.0f} ms, target {delay_target * 1000:.0f} ms",
+            file=sys.stderr,
+        )
+        if p95 > delay_target:
+            print(
+                "p95 is above the target, try a smaller --chunk-seconds "
+                "or another --model",
+                file=sys.stderr,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""Counters, timers and histograms for the decode pipeline.
+
+Instrumentation is off unless SUBTITLE_METRICS=1. When it is off, start_run()
+returns a run whose methods do nothing, and the pipeline only calls them once
+per read window or batch, so the overhead is negligible.
+
+Each finished run is logged as one JSON event on the "subtitle.metrics"
+logger and added to a process-wide registry, which is exported in the
+Prometheus text format to SUBTITLE_METRICS_FILE and/or served over HTTP on
+SUBTITLE_METRICS_PORT.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Tuple
+
+enabled = os.environ.get("SUBTITLE_METRICS", "0") == "1"
+metrics_file = os.environ.get("SUBTITLE_METRICS_FILE")
+metrics_port = os.environ.get("SUBTITLE_METRICS_PORT")
+
+_latency_buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+histogram_buckets = {
+    "segment_duration_seconds": [0.5, 1, 2, 5, 10, 20, 30, 60],
+    "asr_latency_seconds": _latency_buckets,
+    "recognizer_queue_wait_seconds": _latency_buckets,
+    "batch_size": [1, 2, 4, 8, 16, 32, 64, 128],
+    "caption_delay_seconds": [0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 5],
+}
+
+event_logger = logging.getLogger("subtitle.metrics")
+
+
+class _Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float, n: int = 1):
+        self.counts[bisect_left(self.buckets, value)] += n
+        self.sum += value * n
+        self.count += n
+
+
+class Run:
+    """Metrics of one pipeline run, e.g. one call of decode_segments."""
+
+    def __init__(self, name: str, **labels: str):
+        self.name = name
+        self.labels = labels
+        self.started = time.time()
+        self.counters: Dict[str, float] = defaultdict(float)
+        self.histograms: Dict[str, _Histogram] = {}
+        self._lock = threading.Lock()
+
+    def add(self, counter: str, value: float = 1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def observe(self, histogram: str, value: float, n: int = 1):
+        with self._lock:
+            if histogram not in self.histograms:
+                self.histograms[histogram] = _Histogram(histogram_buckets[histogram])
+            self.histograms[histogram].observe(value, n)
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(f"{stage}_seconds", time.perf_counter() - start)
+
+    def finish(self):
+        event = {
+            "event": self.name,
+            "time": self.started,
+            "wall_seconds": time.time() - self.started,
+            **self.labels,
+            **self.counters,
+        }
+        for name, h in self.histograms.items():
+            event[f"{name}_count"] = h.count
+            event[f"{name}_sum"] = h.sum
+        event_logger.info(json.dumps(event))
+
+        # Metrics must not fail the work they measure.
+        try:
+            registry.merge(self)
+        except Exception:
+            logging.exception(f"Failed to export metrics of {self.name}")
+
+
+class _NullRun(Run):
+    def __init__(self):
+        pass
+
+    def add(self, counter: str, value: float = 1):
+        pass
+
+    def observe(self, histogram: str, value: float, n: int = 1):
+        pass
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        yield
+
+    def finish(self):
+        pass
+
+
+null_run = _NullRun()
+
+
+def start_run(name: str, **labels: str) -> Run:
+    if not enabled:
+        return null_run
+    return Run(name, **labels)
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Serializes write(), which shares one temporary file per process.
+        self._write_lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = defaultdict(float)
+        self.histograms: Dict[Tuple[str, Tuple], _Histogram] = {}
+
+    def merge(self, run: Run):
+        labels = tuple(sorted(run.labels.items()))
+        with self._lock:
+            self.counters[(f"{run.name}_runs_total", labels)] += 1
+            for name, value in run.counters.items():
+                self.counters[(f"{run.name}_{name}_total", labels)] += value
+            for name, h in run.histograms.items():
+                key = (f"{run.name}_{name}", labels)
+                if key not in self.histograms:
+                    self.histograms[key] = _Histogram(h.buckets)
+                total = self.histograms[key]
+                total.counts = [a + b for a, b in zip(total.counts, h.counts)]
+                total.sum += h.sum
+                total.count += h.count
+
+        if metrics_file:
+            self.write(metrics_file)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+
+        def fmt(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines.append(f"# TYPE subtitle_{name} counter")
+                for (n, labels), value in self.counters.items():
+                    if n == name:
+                        lines.append(f"subtitle_{name}{fmt(labels)} {value}")
+
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE subtitle_{name} histogram")
+                for (n, labels), h in self.histograms.items():
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for le, count in zip(h.buckets + ["+Inf"], h.counts):
+                        cumulative += count
+                        lines.append(
+                            f"subtitle_{name}_bucket{fmt(labels, le=le)} {cumulative}"
+                        )
+                    lines.append(f"subtitle_{name}_sum{fmt(labels)} {h.sum}")
+                    lines.append(f"subtitle_{name}_count{fmt(labels)} {h.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        with self._write_lock:
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+
+
+registry = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_http_server():
+    """Serve the registry on SUBTITLE_METRICS_PORT, once per process."""
+    global _server
+    if not enabled or not metrics_port:
+        return
+    with _server_lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("", int(metrics_port)), _MetricsHandler)
+            threading.Thread(
+                target=_server.serve_forever, name="metrics-http", daemon=True
+            ).start()
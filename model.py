@@ -1,23 +1,76 @@
-from functools import lru_cache
+import os
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Union
 
 import sherpa_onnx
 import streamlit as st
-from huggingface_hub import hf_hub_download
+
+from model_registry import ModelRegistry
+from paths import cache_dir
+from pool import Pool
+from recognizer_manager import RecognizerManager
+from session_options import SessionOptionsStore
 
 sample_rate = 16000
 
+vad_min_silence_duration = 0.15
+vad_min_speech_duration = 0.25
+# Longer stretches of speech are split at a quiet point, see
+# decode.split_segment(). 0 disables splitting.
+vad_max_segment_duration = float(os.environ.get("SUBTITLE_MAX_SEGMENT_SECONDS", "20"))
+
+# Identifies the VAD settings that shaped a transcript, e.g. for caching.
+vad_config_id = (
+    f"silero:{vad_min_silence_duration}:{vad_min_speech_duration}"
+    f":{vad_max_segment_duration}"
+)
+
+# Number of recognizer instances decode() spreads its batches over.
+num_decoders = int(os.environ.get("SUBTITLE_NUM_DECODERS", "1"))
+
+# Memory budget for loaded recognizers, see RecognizerManager.
+max_model_cache_bytes = int(
+    os.environ.get("SUBTITLE_MODEL_CACHE_BYTES", 4 * 1024 * 1024 * 1024)
+)
+
+# Thread counts and batch sizes tuned per host by tune.py. Set
+# SUBTITLE_SESSION_OPTIONS to a JSON file to override them by hand.
+session_options = SessionOptionsStore(
+    cache_dir / "session_options.json",
+    os.environ.get("SUBTITLE_SESSION_OPTIONS"),
+)
+
+# Number of most frequently chosen models to load when the app starts.
+num_preloaded_models = int(os.environ.get("SUBTITLE_PRELOAD_MODELS", "2"))
+
+# Upper bounds for the number of recognizers per model and of VADs, i.e. for
+# the number of pipelines that can run side by side. The default allows two
+# pipelines per model.
+max_recognizers_per_model = int(
+    os.environ.get("SUBTITLE_RECOGNIZERS_PER_MODEL", 2 * num_decoders)
+)
+vad_pool_size = int(os.environ.get("SUBTITLE_VAD_POOL_SIZE", "4"))
+
+# Seconds of silence after speech that end a live caption; silence before
+# any speech ends it after twice as long.
+live_endpoint_silence = float(os.environ.get("SUBTITLE_LIVE_ENDPOINT_SECONDS", "0.8"))
+# A live caption that runs this many seconds without a pause is ended anyway.
+live_max_caption_duration = float(
+    os.environ.get("SUBTITLE_LIVE_MAX_CAPTION_SECONDS", "20")
+)
+
+# Where the model files are and their checksums. Once a model has been
+# loaded, or prefetched with `python model_registry.py prefetch`, loading it
+# again makes no requests to the Hugging Face Hub.
+registry = ModelRegistry(cache_dir / "model_manifest.json")
+
 
 def _get_nn_model_filename(
     repo_id: str,
     filename: str,
     subfolder: str = "exp",
 ) -> str:
-    nn_model_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
-    )
-    return nn_model_filename
+    return registry.resolve(repo_id, filename, subfolder)
 
 
 get_file = _get_nn_model_filename
@@ -28,12 +81,7 @@ def _get_bpe_model_filename(
     filename: str = "bpe.model",
     subfolder: str = "data/lang_bpe_500",
 ) -> str:
-    bpe_model_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
-    )
-    return bpe_model_filename
+    return registry.resolve(repo_id, filename, subfolder)
 
 
 def _get_token_filename(
@@ -41,18 +89,19 @@ def _get_token_filename(
     filename: str = "tokens.txt",
     subfolder: str = "data/lang_char",
 ) -> str:
-    token_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
-    )
-    return token_filename
-
-
-@st.cache_resource(max_entries=10)
-def _get_whisper_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    name = repo_id.split("-")[1]
-    assert name in ("tiny.en", "base.en", "small.en", "medium.en"), repo_id
+    return registry.resolve(repo_id, filename, subfolder)
+
+
+def _get_whisper_model(repo_id: str, num_threads: int = 2) -> sherpa_onnx.OfflineRecognizer:
+    name = repo_id[len("whisper-") :]
+    assert name in (
+        "tiny.en",
+        "base.en",
+        "small.en",
+        "distil-small.en",
+        "medium.en",
+        "distil-medium.en",
+    ), repo_id
     full_repo_id = "csukuangfj/sherpa-onnx-whisper-" + name
     encoder = _get_nn_model_filename(
         repo_id=full_repo_id,
@@ -74,14 +123,13 @@ def _get_whisper_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
         encoder=encoder,
         decoder=decoder,
         tokens=tokens,
-        num_threads=2,
+        num_threads=num_threads,
     )
 
     return recognizer
 
 
-@st.cache_resource(max_entries=10)
-def _get_paraformer_zh_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
+def _get_paraformer_zh_pre_trained_model(repo_id: str, num_threads: int = 2) -> sherpa_onnx.OfflineRecognizer:
     assert repo_id in [
         "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28",
     ], repo_id
@@ -97,7 +145,7 @@ def _get_paraformer_zh_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRec
     recognizer = sherpa_onnx.OfflineRecognizer.from_paraformer(
         paraformer=nn_model,
         tokens=tokens,
-        num_threads=2,
+        num_threads=num_threads,
         sample_rate=sample_rate,
         feature_dim=80,
         decoding_method="greedy_search",
@@ -107,8 +155,7 @@ def _get_paraformer_zh_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRec
     return recognizer
 
 
-@st.cache_resource(max_entries=10)
-def _get_russian_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
+def _get_russian_pre_trained_model(repo_id: str, num_threads: int = 2) -> sherpa_onnx.OfflineRecognizer:
     assert repo_id in (
         "alphacep/vosk-model-ru",
         "alphacep/vosk-model-small-ru",
@@ -144,7 +191,7 @@ def _get_russian_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognize
         encoder=encoder_model,
         decoder=decoder_model,
         joiner=joiner_model,
-        num_threads=2,
+        num_threads=num_threads,
         sample_rate=16000,
         feature_dim=80,
         decoding_method="greedy_search",
@@ -153,18 +200,18 @@ def _get_russian_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognize
     return recognizer
 
 
-@lru_cache(maxsize=2)
-def get_vad() -> sherpa_onnx.VoiceActivityDetector:
-    vad_model = _get_nn_model_filename(
-        repo_id="csukuangfj/vad",
-        filename="silero_vad.onnx",
-        subfolder=".",
-    )
+def create_vad() -> sherpa_onnx.VoiceActivityDetector:
+    with registry.recording("vad"):
+        vad_model = _get_nn_model_filename(
+            repo_id="csukuangfj/vad",
+            filename="silero_vad.onnx",
+            subfolder=".",
+        )
 
     config = sherpa_onnx.VadModelConfig()
     config.silero_vad.model = vad_model
-    config.silero_vad.min_silence_duration = 0.15
-    config.silero_vad.min_speech_duration = 0.25
+    config.silero_vad.min_silence_duration = vad_min_silence_duration
+    config.silero_vad.min_speech_duration = vad_min_speech_duration
     config.sample_rate = sample_rate
 
     vad = sherpa_onnx.VoiceActivityDetector(
@@ -175,21 +222,67 @@ def get_vad() -> sherpa_onnx.VoiceActivityDetector:
     return vad
 
 
-@st.cache_resource(max_entries=10)
-def get_pretrained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
+# A VAD keeps state between calls, so pipelines that run at the same time
+# each check out their own.
+vad_pool = Pool(create_vad, vad_pool_size, reset=lambda vad: vad.reset())
+
+
+def checkout_vad():
+    """Lend a reset VAD for the with block."""
+    return vad_pool.checkout()
+
+
+def _load_pretrained_model(
+    repo_id: str, num_threads: Optional[int] = None
+) -> Union[sherpa_onnx.OfflineRecognizer, sherpa_onnx.OnlineRecognizer]:
+    if num_threads is None:
+        num_threads = session_options.get(repo_id).num_threads
+
     if repo_id in chinese_models:
-        return chinese_models[repo_id](repo_id)
+        loader = chinese_models[repo_id]
     elif repo_id in english_models:
-        return english_models[repo_id](repo_id)
+        loader = english_models[repo_id]
     elif repo_id in chinese_english_mixed_models:
-        return chinese_english_mixed_models[repo_id](repo_id)
+        loader = chinese_english_mixed_models[repo_id]
     elif repo_id in russian_models:
-        return russian_models[repo_id](repo_id)
+        loader = russian_models[repo_id]
+    elif repo_id in live_models:
+        loader = live_models[repo_id]
     else:
         raise ValueError(f"Unsupported repo_id: {repo_id}")
 
+    with registry.recording(repo_id):
+        return loader(repo_id, num_threads)
+
+
+recognizer_manager = RecognizerManager(
+    _load_pretrained_model,
+    max_bytes=max_model_cache_bytes,
+    usage_path=cache_dir / "model_usage.json",
+    max_instances_per_model=max_recognizers_per_model,
+)
+
+
+@contextmanager
+def checkout_recognizers(
+    repo_id: str, num_instances: int = num_decoders
+) -> Iterator[List[sherpa_onnx.OfflineRecognizer]]:
+    """Lend independent recognizers of repo_id for the with block, for
+    decode_segments() to spread its batches over. No other caller uses them
+    until the block ends."""
+    with recognizer_manager.checkout(repo_id, num_instances) as recognizers:
+        yield recognizers
+
 
-def _get_wenetspeech_pre_trained_model(repo_id):
+@st.cache_resource
+def start_model_preloading():
+    # cache_resource makes this run once per process.
+    return recognizer_manager.preload(
+        recognizer_manager.most_used(num_preloaded_models)
+    )
+
+
+def _get_wenetspeech_pre_trained_model(repo_id, num_threads=2):
     assert repo_id in (
         "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23",
     ), repo_id
@@ -219,7 +312,7 @@ def _get_wenetspeech_pre_trained_model(repo_id):
         encoder=encoder_model,
         decoder=decoder_model,
         joiner=joiner_model,
-        num_threads=2,
+        num_threads=num_threads,
         sample_rate=16000,
         feature_dim=80,
         decoding_method="greedy_search",
@@ -228,7 +321,7 @@ def _get_wenetspeech_pre_trained_model(repo_id):
     return recognizer
 
 
-def _get_multi_zh_hans_pre_trained_model(repo_id):
+def _get_multi_zh_hans_pre_trained_model(repo_id, num_threads=2):
     assert repo_id in ("zrjin/sherpa-onnx-zipformer-multi-zh-hans-2023-9-2",), repo_id
 
     encoder_model = _get_nn_model_filename(
@@ -256,7 +349,7 @@ def _get_multi_zh_hans_pre_trained_model(repo_id):
         encoder=encoder_model,
         decoder=decoder_model,
         joiner=joiner_model,
-        num_threads=2,
+        num_threads=num_threads,
         sample_rate=16000,
         feature_dim=80,
         decoding_method="greedy_search",
@@ -265,7 +358,7 @@ def _get_multi_zh_hans_pre_trained_model(repo_id):
     return recognizer
 
 
-def _get_english_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
+def _get_english_model(repo_id: str, num_threads: int = 2) -> sherpa_onnx.OfflineRecognizer:
     assert (
         repo_id
         == "yfyeung/icefall-asr-multidataset-pruned_transducer_stateless7-2023-05-04"
@@ -296,7 +389,7 @@ def _get_english_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
         encoder=encoder_model,
         decoder=decoder_model,
         joiner=joiner_model,
-        num_threads=2,
+        num_threads=num_threads,
         sample_rate=16000,
         feature_dim=80,
         decoding_method="greedy_search",
@@ -305,6 +398,54 @@ def _get_english_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
     return recognizer
 
 
+def _get_streaming_zipformer_model(
+    repo_id: str, num_threads: int = 2
+) -> sherpa_onnx.OnlineRecognizer:
+    epochs = {
+        "csukuangfj/sherpa-onnx-streaming-zipformer-en-2023-06-26": "epoch-99-avg-1-chunk-16-left-128",  # noqa
+        "csukuangfj/sherpa-onnx-streaming-zipformer-bilingual-zh-en-2023-02-20": "epoch-99-avg-1",  # noqa
+    }
+    assert repo_id in epochs, repo_id
+    epoch = epochs[repo_id]
+
+    encoder_model = _get_nn_model_filename(
+        repo_id=repo_id,
+        filename=f"encoder-{epoch}.onnx",
+        subfolder=".",
+    )
+
+    decoder_model = _get_nn_model_filename(
+        repo_id=repo_id,
+        filename=f"decoder-{epoch}.onnx",
+        subfolder=".",
+    )
+
+    joiner_model = _get_nn_model_filename(
+        repo_id=repo_id,
+        filename=f"joiner-{epoch}.onnx",
+        subfolder=".",
+    )
+
+    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
+
+    recognizer = sherpa_onnx.OnlineRecognizer.from_transducer(
+        tokens=tokens,
+        encoder=encoder_model,
+        decoder=decoder_model,
+        joiner=joiner_model,
+        num_threads=num_threads,
+        sample_rate=sample_rate,
+        feature_dim=80,
+        decoding_method="greedy_search",
+        enable_endpoint_detection=True,
+        rule1_min_trailing_silence=live_endpoint_silence * 2,
+        rule2_min_trailing_silence=live_endpoint_silence,
+        rule3_min_utterance_length=live_max_caption_duration,
+    )
+
+    return recognizer
+
+
 chinese_models = {
     "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28": _get_paraformer_zh_pre_trained_model,
     "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23": _get_wenetspeech_pre_trained_model,  # noqa
@@ -330,6 +471,15 @@ russian_models = {
     "alphacep/vosk-model-small-ru": _get_russian_pre_trained_model,
 }
 
+# Streaming models, for live captions (see live.py). They get a language
+# group of their own, since they cannot decode a file with decode_segments().
+live_models = {
+    "csukuangfj/sherpa-onnx-streaming-zipformer-en-2023-06-26": _get_streaming_zipformer_model,  # noqa
+    "csukuangfj/sherpa-onnx-streaming-zipformer-bilingual-zh-en-2023-02-20": _get_streaming_zipformer_model,  # noqa
+}
+
+live_language = "Live"
+
 language_to_models = {
     "English": list(english_models.keys()),
     "Chinese": list(chinese_models.keys()),
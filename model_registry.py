@@ -0,0 +1,274 @@
+"""Local registry of model files, so that loading a model needs no network.
+
+Each model file is fetched from the Hugging Face Hub once, ahead of time with
+`python model_registry.py prefetch` or else on first use. It is recorded in
+a manifest with its SHA-256, size and modification time. Later lookups only
+stat the file. If size and modification time still match the manifest, the
+file is used without a request to the hub and without hashing it again. A
+file whose modification time changed is hashed once more, and downloaded
+again if the hash no longer matches.
+
+The manifest also lists the files of every model loaded so far, so that
+`python model_registry.py verify` can tell which entries of
+model.language_to_models are ready for offline use.
+
+Usage:
+
+    python model_registry.py prefetch [--models ...]
+    python model_registry.py verify [--models ...] [--full]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from huggingface_hub import hf_hub_download
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: manifest updates of concurrent processes may overwrite each
+    # other.
+    fcntl = None
+
+chunk_size = 8 * 1024 * 1024
+
+# Files the hub stores with Git LFS are cached under their SHA-256.
+_lfs_blob_name = re.compile("[0-9a-f]{64}")
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while n := f.readinto(buffer):
+            sha256.update(view[:n])
+    return sha256.hexdigest()
+
+
+@dataclass
+class FileEntry:
+    path: str
+    sha256: str
+    size: int
+    mtime_ns: int
+
+
+class ModelRegistry:
+    def __init__(self, manifest_path: Path):
+        self.manifest_path = Path(manifest_path)
+        self._lock = threading.Lock()
+        self._recording = threading.local()
+        self._files, self._models = self._read()
+
+    def _read(self) -> Tuple[Dict[str, FileEntry], Dict[str, List[str]]]:
+        manifest = {}
+        try:
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.exception(f"Ignoring unreadable {self.manifest_path}")
+        files = {
+            key: FileEntry(**entry) for key, entry in manifest.get("files", {}).items()
+        }
+        return files, manifest.get("models", {})
+
+    @staticmethod
+    def _key(repo_id: str, filename: str, subfolder: str) -> str:
+        return posixpath.normpath(posixpath.join(repo_id, subfolder, filename))
+
+    def resolve(self, repo_id: str, filename: str, subfolder: str = ".") -> str:
+        """Local path of a file of a hub repository, downloaded if needed."""
+        key = self._key(repo_id, filename, subfolder)
+        with self._lock:
+            entry = self._files.get(key)
+
+        if entry is None or not self._is_intact(key, entry):
+            entry = self._fetch(repo_id, filename, subfolder, force=entry is not None)
+            with self._lock:
+                self._save(files={key: entry})
+
+        keys = getattr(self._recording, "keys", None)
+        if keys is not None:
+            keys.append(key)
+        return entry.path
+
+    def _is_intact(self, key: str, entry: FileEntry, full: bool = False) -> bool:
+        try:
+            stat = os.stat(entry.path)
+        except OSError:
+            return False
+        if stat.st_size != entry.size:
+            return False
+        if stat.st_mtime_ns == entry.mtime_ns and not full:
+            return True
+
+        # Touched, e.g. by a copy or a restore from backup; the content
+        # decides.
+        if _sha256(entry.path) != entry.sha256:
+            logging.warning(f"{key} does not match its checksum")
+            return False
+        if stat.st_mtime_ns != entry.mtime_ns:
+            with self._lock:
+                entry.mtime_ns = stat.st_mtime_ns
+                self._save(files={key: entry})
+        return True
+
+    def _fetch(
+        self, repo_id: str, filename: str, subfolder: str, force: bool = False
+    ) -> FileEntry:
+        path = hf_hub_download(
+            repo_id=repo_id,
+            filename=filename,
+            subfolder=subfolder,
+            force_download=force,
+        )
+        sha256 = _sha256(path)
+
+        blob_name = os.path.basename(os.path.realpath(path))
+        if _lfs_blob_name.fullmatch(blob_name) and blob_name != sha256:
+            if not force:
+                return self._fetch(repo_id, filename, subfolder, force=True)
+            raise IOError(
+                f"{self._key(repo_id, filename, subfolder)} is corrupt: "
+                f"SHA-256 {sha256}, expected {blob_name}"
+            )
+
+        stat = os.stat(path)
+        return FileEntry(path, sha256, stat.st_size, stat.st_mtime_ns)
+
+    def _save(
+        self,
+        files: Optional[Dict[str, FileEntry]] = None,
+        models: Optional[Dict[str, List[str]]] = None,
+    ):
+        """Add files and models to the manifest, in memory and on disk.
+
+        Other processes, e.g. batch workers, update the same manifest, so it
+        is read again and merged under a lock instead of overwritten with
+        what this process knows. Entries on disk win over older ones in
+        memory, the given ones over both.
+        """
+        # Called with _lock held.
+        self.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.manifest_path.with_suffix(".lock"), "a") as lock:
+            if fcntl is not None:
+                # Released when the file is closed.
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            disk_files, disk_models = self._read()
+            self._files = {**self._files, **disk_files, **(files or {})}
+            self._models = {**self._models, **disk_models, **(models or {})}
+
+            manifest = {
+                "files": {key: asdict(entry) for key, entry in self._files.items()},
+                "models": self._models,
+            }
+            tmp = self.manifest_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp, self.manifest_path)
+
+    @contextmanager
+    def recording(self, model: str) -> Iterator[None]:
+        """Record the files resolved in the with block as those of model."""
+        self._recording.keys = []
+        try:
+            yield
+            keys = list(dict.fromkeys(self._recording.keys))
+            with self._lock:
+                if self._models.get(model) != keys:
+                    self._save(models={model: keys})
+        finally:
+            self._recording.keys = None
+
+    def verify(self, model: str, full: bool = False) -> List[str]:
+        """Problems that keep model from loading offline, none if it can.
+
+        With full, every file is hashed, not only those that were touched.
+        """
+        with self._lock:
+            keys = self._models.get(model)
+        if keys is None:
+            return [f"{model} is not in the manifest"]
+
+        problems = []
+        for key in keys:
+            with self._lock:
+                entry = self._files.get(key)
+            if entry is None:
+                problems.append(f"{key} is not in the manifest")
+            elif not self._is_intact(key, entry, full):
+                problems.append(f"{key} is missing or corrupt")
+        return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", choices=["prefetch", "verify"])
+    parser.add_argument("--models", nargs="+")
+    parser.add_argument("--full", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    from model import (
+        _load_pretrained_model,
+        create_vad,
+        language_to_models,
+        live_models,
+        registry,
+    )
+
+    models = args.models or list(
+        dict.fromkeys(
+            [m for models in language_to_models.values() for m in models]
+            + list(live_models)
+        )
+    )
+
+    failed = False
+    if args.command == "prefetch":
+        # Loading each model once downloads all of its files and checks that
+        # they make a working recognizer.
+        loaders = {"vad": create_vad}
+        for repo_id in models:
+            loaders[repo_id] = lambda repo_id=repo_id: _load_pretrained_model(
+                repo_id, num_threads=1
+            )
+        for name, load in loaders.items():
+            start = time.perf_counter()
+            try:
+                load()
+            except Exception as e:
+                print(f"{name}: failed: {e}", file=sys.stderr)
+                failed = True
+                continue
+            print(f"{name}: ready in {time.perf_counter() - start:.1f} s")
+    else:
+        for name in ["vad"] + models:
+            problems = registry.verify(name, args.full)
+            for problem in problems:
+                print(f"{name}: {problem}", file=sys.stderr)
+            if problems:
+                failed = True
+            else:
+                print(f"{name}: ok")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
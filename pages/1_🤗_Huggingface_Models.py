@@ -1,73 +1,127 @@
-import hashlib
 import logging
-import os
+import time
+import uuid
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
 
 import streamlit as st
 
 st.set_page_config(layout="centered")
-from streamlit.elements.lib.subtitle_utils import _srt_to_vtt
 
-from decode import decode
-from model import get_pretrained_model, get_vad, language_to_models
-from utils import data_to_webvtt, vtt_string_to_dataframe
+import live
+import metrics
+from audio_source import probe, probe_duration
+from ingest import ingest_path, ingest_upload
+from jobs import scheduler
+from model import (
+    checkout_recognizers,
+    language_to_models,
+    live_language,
+    live_models,
+    recognizer_manager,
+    start_model_preloading,
+)
+from segment_table import SegmentTable
+from transcript_cache import get_transcript_cache
+from utils import EditableSubtitles, segment_table_to_dataframe
 
 
 def show_file_info(in_filename: str):
     logging.info(f"Input file: {in_filename}")
-    _ = os.system(f"ffprobe -hide_banner -i '{in_filename}'")
-
+    logging.info(probe(in_filename))
 
-def process(language: str, repo_id: str, in_filename: str):
-    recognizer = get_pretrained_model(repo_id)
-    vad = get_vad()
 
-    result = decode(recognizer, vad, in_filename)
-    logging.info(result)
+# Minimum number of seconds between two re-renders of the video preview.
+preview_interval = 5
 
-    vtt_filename = Path(in_filename).with_suffix(".vtt")
-    result = _srt_to_vtt(result)
+# Seconds between two looks at the state of a running job.
+poll_interval = 0.5
 
-    show_file_info(in_filename)
-    logging.info("Done")
 
-    return (
-        vtt_filename,
-        st.toast("Success! Download the subtitles below.", icon="🍿"),
-        result,
+def show_subtitles(table: SegmentTable, vtt_filename: Path):
+    # The editor keeps showing this version; edits are applied incrementally.
+    st.session_state.editable_subtitles = EditableSubtitles(
+        segment_table_to_dataframe(table)
     )
+    st.session_state.vtt_filename = vtt_filename
+    st.toast("Success! Download the subtitles below.", icon="🍿")
 
-def process_uploaded_video_file(
-    language: str,
-    repo_id: str,
-    in_filename: str,
-):
-    if in_filename is None or in_filename == "":
-        return (
-            "",
-            st.error(
-                "Please first upload a file"
-            ),
-            "",
-            "",
-        )
-
-    logging.info(f"Processing uploaded file: {in_filename}")
 
-    ans = process(language, repo_id, in_filename)
-    return ans[0], ans[1], ans[2]
+sample_video_path = "example.mp4"
 
-def calculate_file_hash(file):
-    sha256_hash = hashlib.sha256()
-    # Read the file in chunks to avoid using too much memory
-    for byte_block in iter(lambda: file.read(4096), b""):
-        sha256_hash.update(byte_block)
-    file.seek(0)  # Reset file pointer to the beginning
-    return sha256_hash.hexdigest()
 
-sample_video_path = "example.mp4"
-temp_upload_path = "temp_uploaded_video.mp4"
+def show_live_captions(repo_id: str):
+    # Browser users may only pick files of their own or sources configured
+    # on the server; the command line takes any ffmpeg input.
+    source_names = ["Sample video", "Uploaded file"] + list(live.configured_sources)
+    source_name = st.selectbox("Audio source", source_names)
+    if source_name == "Sample video":
+        source = ingest_path(sample_video_path).path
+    elif source_name == "Uploaded file":
+        uploaded = st.file_uploader(
+            "Upload a recording", type=["mp4", "webm", "wav", "mp3", "m4a"]
+        )
+        if uploaded is None:
+            return
+        source = ingest_upload(uploaded).path
+    else:
+        source = live.configured_sources[source_name]
+    # Finished files are played at their own pace, as if they were live.
+    realtime = source_name in ("Sample video", "Uploaded file")
+
+    chunk_seconds = st.slider(
+        "Chunk size (seconds)",
+        min_value=0.05,
+        max_value=1.0,
+        value=live.chunk_seconds,
+        step=0.05,
+        help="Smaller chunks show captions sooner, at some cost in CPU.",
+    )
+    if not st.button("Start live captions"):
+        return
+    recognizer_manager.record_use(repo_id)
+
+    partial_placeholder = st.empty()
+    finals_placeholder = st.empty()
+    delay_placeholder = st.empty()
+    finals = []
+    delays = []
+    # Any widget interaction reruns the script, which stops reading.
+    with checkout_recognizers(repo_id, 1) as (recognizer,), closing(
+        live.captions(
+            recognizer, source, chunk_seconds, realtime=realtime, follow=not realtime
+        )
+    ) as captions:
+        for caption in captions:
+            delays.append(caption.delay)
+            if caption.final:
+                finals.append(caption.segment)
+                partial_placeholder.empty()
+                finals_placeholder.dataframe(
+                    segment_table_to_dataframe(SegmentTable.from_segments(finals)),
+                    use_container_width=True,
+                )
+            else:
+                partial_placeholder.markdown(f"**{caption.segment.text}**")
+            delay_placeholder.caption(
+                f"Caption delay {caption.delay * 1000:.0f} ms, "
+                f"target {live.delay_target * 1000:.0f} ms"
+            )
+
+    if finals:
+        st.download_button(
+            label="Download VTT",
+            data=SegmentTable.from_segments(finals).to_vtt(),
+            file_name="live.vtt",
+            mime="text/vtt",
+        )
+    if delays:
+        st.caption(
+            f"Caption delay over {len(delays)} captions: "
+            f"median {sorted(delays)[len(delays) // 2] * 1000:.0f} ms, "
+            f"max {max(delays) * 1000:.0f} ms"
+        )
 
 st.header("Subtitle Generation with Hugging Face LLMs", divider=True)
 
@@ -78,69 +132,150 @@ See the [NOTICES](https://github.com/kajarenc/subtitle-demo/blob/main/NOTICES) f
 """
 )
 
-language_choices = list(language_to_models.keys())
+start_model_preloading()
+metrics.start_http_server()
+
+# Identifies this browser session to the job scheduler.
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
+
+with st.sidebar.expander("Model cache"):
+    st.json(recognizer_manager.stats())
+
+with st.sidebar.expander("Jobs"):
+    st.json(scheduler.stats())
+
+language_choices = list(language_to_models.keys()) + [live_language]
 
 language_radio = st.radio("Select a language", language_choices, index=0, horizontal=True)
 
-model_selectbox = st.selectbox(
-    "Select a model", language_to_models[language_radio], index=0
-)
+if language_radio == live_language:
+    model_choices = list(live_models)
+else:
+    model_choices = language_to_models[language_radio]
+
+model_selectbox = st.selectbox("Select a model", model_choices, index=0)
+
+if language_radio == live_language:
+    show_live_captions(model_selectbox)
+    st.stop()
 
 uploaded_video = st.file_uploader("Upload a video to caption", type=["mp4", "webm"])
 
 video_placeholder = st.empty()
 
 if uploaded_video is not None:
-    file_hash = calculate_file_hash(uploaded_video)
+    # Spooled to disk and hashed once per upload, not on every rerun.
+    ingested = ingest_upload(uploaded_video)
     video_to_process = uploaded_video
     original_file_name = uploaded_video.name
-
-    # Check if the uploaded file has the same name as the sample video
-    if original_file_name == os.path.basename(sample_video_path):
-        file_name_to_use = temp_upload_path
-    else:
-        file_name_to_use = original_file_name
-    
-    with open(file_name_to_use, "wb") as f:
-        f.write(uploaded_video.read())
-
 else:
     st.info("No video uploaded yet. Using the sample video.", icon="📽️")
     # Use the sample video if no video is uploaded
-    video_to_process = open(sample_video_path, "rb")
-    file_name_to_use = sample_video_path
-    file_hash = calculate_file_hash(video_to_process)
-    video_to_process.seek(0)
+    ingested = ingest_path(sample_video_path)
+    video_to_process = sample_video_path
+    original_file_name = sample_video_path
+
+file_name_to_use = ingested.path
+file_hash = ingested.sha256
 
 content_change = (st.session_state.get('uploaded_video_hash') != file_hash)
 model_change = (st.session_state.get('last_used_model') != model_selectbox)
-video_change = (st.session_state.get('uploaded_video_name') != file_name_to_use)
+video_change = (st.session_state.get('uploaded_video_name') != original_file_name)
 
-if 'edited_subtitles' not in st.session_state or model_change or video_change or content_change:
+if 'editable_subtitles' not in st.session_state or model_change or video_change or content_change:
     # If the uploaded video is new or different, reset the edited subtitles in the session state
-    st.session_state.edited_subtitles = None
-    st.session_state.uploaded_video_name = file_name_to_use
+    st.session_state.editable_subtitles = None
+    scheduler.cancel(st.session_state.get("job_id"))
+    st.session_state.job_id = None
+    st.session_state.uploaded_video_name = original_file_name
     st.session_state.last_used_model = model_selectbox
     st.session_state.uploaded_video_hash = file_hash
 
 video_placeholder.video(video_to_process, start_time=1)
 
 if st.button('Generate Subtitles'):
-    st.session_state['generation_triggered'] = True
-else:
-    st.session_state['generation_triggered'] = False
-
-if 'generation_triggered' in st.session_state and st.session_state['generation_triggered']:
-    st.toast("Generating subtitles...", icon="⏳")
-    vtt_filename, _, subtitles = process_uploaded_video_file(
-        language_radio, model_selectbox, file_name_to_use
-    )
+    recognizer_manager.record_use(model_selectbox)
+    vtt_filename = Path(original_file_name).with_suffix(".vtt")
+    table = get_transcript_cache().get(file_hash, model_selectbox)
+    if table is not None:
+        logging.info(f"Using cached transcript for {original_file_name}")
+        show_subtitles(table, vtt_filename)
+    else:
+        st.toast("Generating subtitles...", icon="⏳")
+        try:
+            duration = probe_duration(file_name_to_use)
+        except Exception:
+            duration = None
+        scheduler.cancel(st.session_state.get("job_id"))
+        st.session_state.job_id = scheduler.submit(
+            st.session_state.session_id,
+            model_selectbox,
+            file_name_to_use,
+            file_hash,
+            duration,
+        )
+        st.session_state.vtt_filename = vtt_filename
+
+job = scheduler.get(st.session_state.get("job_id"))
+if job is not None:
+    if st.button("Cancel"):
+        scheduler.cancel(job.id)
+
+    progress_bar = st.progress(0.0)
+    progress_placeholder = st.empty()
+    last_preview_time = 0.0
+    num_shown = 0
+
+    # Any widget interaction reruns the script and ends this loop; the job
+    # goes on and is picked up again by the next run.
+    while True:
+        done = job.done
+        if job.state == "queued":
+            text = f"Waiting for {scheduler.position(job.id)} other jobs"
+        else:
+            text = f"Decoded {job.progress:.0f} s of audio"
+        progress_bar.progress(job.fraction, text=text)
+
+        segments = list(job.segments)
+        if len(segments) > num_shown:
+            num_shown = len(segments)
+            partial_table = SegmentTable.from_segments(segments)
+            progress_placeholder.dataframe(
+                segment_table_to_dataframe(partial_table), use_container_width=True
+            )
+            if time.monotonic() - last_preview_time > preview_interval:
+                last_preview_time = time.monotonic()
+                video_placeholder.video(
+                    video_to_process,
+                    start_time=1,
+                    subtitles=partial_table.to_vtt().encode("utf-8"),
+                )
+
+        if done:
+            break
+        time.sleep(poll_interval)
+
+    progress_bar.empty()
+    progress_placeholder.empty()
+    st.session_state.job_id = None
+
+    if job.state == "done":
+        show_file_info(job.filename)
+        logging.info("Done")
+        show_subtitles(job.result, st.session_state.vtt_filename)
+    elif job.state == "failed":
+        st.error(f"Failed to generate subtitles: {job.error}")
+    else:
+        st.info("Cancelled.")
 
-    # Determine the initial data for the data editor
-    initial_data = st.session_state.edited_subtitles if st.session_state.edited_subtitles is not None else vtt_string_to_dataframe(subtitles.decode("utf-8"))
+if st.session_state.editable_subtitles is not None:
+    editable_subtitles = st.session_state.editable_subtitles
+    vtt_filename = st.session_state.vtt_filename
 
     edited_df = st.data_editor(
-        initial_data,
+        editable_subtitles.base,
+        key="subtitle_editor",
         use_container_width=True,
         column_config={
             "text": st.column_config.TextColumn(
@@ -158,22 +293,20 @@ if 'generation_triggered' in st.session_state and st.session_state['generation_t
         },
     )
 
-    # Store the edited subtitles in session_state
-    st.session_state.edited_subtitles = edited_df
+    editable_subtitles.update(edited_df, st.session_state.subtitle_editor)
 
-    edited_subtitles = data_to_webvtt(st.session_state.edited_subtitles.to_dict(orient="records"))
-    video_placeholder.video(video_to_process, start_time=1, subtitles=edited_subtitles.encode('utf-8'))
+    # The same bytes object is passed on every rerun until a cue changes, so
+    # the video is not reloaded for edits that do not change the subtitles.
+    video_placeholder.video(
+        video_to_process, start_time=1, subtitles=editable_subtitles.vtt_bytes
+    )
 
     st.download_button(
         label=f":rainbow[Download {vtt_filename.name}]",
-        data=edited_subtitles.encode('utf-8'),
+        data=editable_subtitles.vtt_bytes,
         file_name=f"{vtt_filename.name}",
         mime="text/vtt",
     )
 
     with st.expander("View raw subtitles"):
-        st.text(edited_subtitles)
-
-    # Delete the file from disk if not the sample video.
-    if file_name_to_use != sample_video_path:
-        os.remove(file_name_to_use)
+        st.text(editable_subtitles.vtt)
@@ -0,0 +1,7 @@
+"""Where the app keeps its caches, importable without loading sherpa-onnx."""
+import os
+from pathlib import Path
+
+cache_dir = Path(
+    os.environ.get("SUBTITLE_CACHE_DIR", Path.home() / ".cache" / "subtitle-demo")
+)
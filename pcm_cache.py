@@ -0,0 +1,133 @@
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+from model import cache_dir, sample_rate
+
+# Upper bound for the size of all stored PCM files together.
+max_pcm_cache_bytes = int(
+    os.environ.get("SUBTITLE_PCM_CACHE_BYTES", 2 * 1024 * 1024 * 1024)
+)
+
+# A temporary file that was not written to for this many seconds was left
+# behind by a process that died while decoding, and is removed.
+stale_tmp_seconds = 3600
+
+
+class PcmWriter:
+    """Collects the PCM of one file; see PcmCache.writer()."""
+
+    def __init__(self, cache: "PcmCache", file_hash: str):
+        self._cache = cache
+        self._file_hash = file_hash
+        self._file = tempfile.NamedTemporaryFile(
+            dir=cache.path, suffix=".tmp", delete=False
+        )
+        self.committed = False
+
+    def write(self, samples: np.ndarray):
+        self._file.write(samples)
+
+    def commit(self):
+        """Store what was written as the complete PCM of the file."""
+        try:
+            self._file.close()
+            os.replace(self._file.name, self._cache.filename(self._file_hash))
+        except BaseException:
+            self.abort()
+            raise
+        self.committed = True
+        self._cache._evict()
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.unlink(self._file.name)
+        except FileNotFoundError:
+            pass
+
+
+class PcmCache:
+    """On-disk LRU cache of decoded audio, 16 kHz mono int16 per file hash.
+
+    Entries are raw s16le files that get() maps into memory, so switching
+    models on the same file skips ffmpeg and the pages of audio are shared
+    by all pipelines that read them. Files are replaced atomically, and a
+    file that is evicted stays readable for the pipelines that mapped it.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def filename(self, file_hash: str) -> Path:
+        return self.path / f"{file_hash}.s16le"
+
+    def get(self, file_hash: str) -> Optional[np.ndarray]:
+        filename = self.filename(file_hash)
+        try:
+            # The modification time doubles as the last access time.
+            os.utime(filename)
+            if filename.stat().st_size == 0:
+                return np.zeros(0, dtype=np.int16)
+            return np.memmap(filename, dtype=np.int16, mode="r")
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def writer(self, file_hash: str) -> Iterator[PcmWriter]:
+        """Yield a writer for the PCM of file_hash.
+
+        Nothing is stored unless the writer is committed before the block
+        ends, e.g. when decoding is cancelled halfway.
+        """
+        writer = PcmWriter(self, file_hash)
+        try:
+            yield writer
+        finally:
+            if not writer.committed:
+                writer.abort()
+
+    def _evict(self):
+        now = time.time()
+        for filename in self.path.glob("*.tmp"):
+            try:
+                if now - filename.stat().st_mtime > stale_tmp_seconds:
+                    filename.unlink()
+                    logging.info(f"Removed stale {filename.name}")
+            except FileNotFoundError:
+                pass
+
+        entries = []
+        for filename in self.path.glob("*.s16le"):
+            try:
+                stat = filename.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                filename.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            logging.info(
+                f"Evicted {size / 2 / sample_rate:.0f} s of PCM {filename.name}"
+            )
+
+
+@lru_cache(maxsize=1)
+def get_pcm_cache() -> PcmCache:
+    return PcmCache(cache_dir / "pcm", max_pcm_cache_bytes)
@@ -0,0 +1,64 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class Pool:
+    """Instances of a stateful object, each used by one caller at a time.
+
+    Instances are created on demand, up to max_size, and reused afterwards,
+    so construction is paid once per concurrent user rather than once per
+    use. reset is applied to an instance every time it is checked out.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[], Any],
+        max_size: int,
+        reset: Optional[Callable[[Any], None]] = None,
+    ):
+        self.factory = factory
+        self.max_size = max(1, max_size)
+        self.reset = reset
+
+        self._idle: List[Any] = []
+        self._size = 0
+        self._available = threading.Condition()
+
+    @contextmanager
+    def checkout(self) -> Iterator[Any]:
+        """Block until an instance is free and lend it for the with block."""
+        with self._available:
+            while not self._idle and self._size >= self.max_size:
+                self._available.wait()
+            if self._idle:
+                obj = self._idle.pop()
+            else:
+                obj = None
+                self._size += 1
+
+        if obj is None:
+            try:
+                obj = self.factory()
+            except BaseException:
+                with self._available:
+                    self._size -= 1
+                    self._available.notify()
+                raise
+
+        try:
+            if self.reset is not None:
+                self.reset(obj)
+            yield obj
+        finally:
+            with self._available:
+                self._idle.append(obj)
+                self._available.notify()
+
+    def stats(self) -> Dict[str, int]:
+        with self._available:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "max_size": self.max_size,
+            }
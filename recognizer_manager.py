@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+
+def _resident_bytes() -> int:
+    """Resident set size of this process, 0 where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+@dataclass
+class _Entry:
+    recognizer: Any
+    num_bytes: int
+    load_seconds: float
+
+
+class RecognizerManager:
+    """LRU cache of recognizers bounded by the memory they occupy.
+
+    The size of a recognizer is the growth of the resident set size while it
+    is loaded. Loads are serialized so that this measurement is not disturbed
+    by other loads. Decodes that run meanwhile allocate memory too, so a size
+    is only measured while no other recognizer is checked out; otherwise the
+    size of an earlier instance of the same model is reused, or, for a model
+    never measured in quiet, the skewed measurement is taken as it is.
+
+    How often users choose each model, see record_use(), is persisted to
+    usage_path, so that the most popular models can be preloaded when the app
+    starts.
+
+    checkout() lends recognizers to one caller at a time, so that callers can
+    decode in parallel without sharing a recognizer. At most
+    max_instances_per_model recognizers of a model exist, and the ones that
+    are checked out are never evicted.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Any],
+        max_bytes: int,
+        max_entries: int = 10,
+        usage_path: Optional[Path] = None,
+        max_instances_per_model: int = 2,
+    ):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.usage_path = usage_path
+        self.max_instances_per_model = max(1, max_instances_per_model)
+
+        self._entries: "OrderedDict[Tuple[str, int], _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # Notified whenever checked out recognizers are returned.
+        self._returned = threading.Condition(self._lock)
+        self._checked_out: Set[Tuple[str, int]] = set()
+        # Counts checkouts, to tell whether one started during a load.
+        self._num_checkouts = 0
+        # Sizes measured while nothing else was checked out, by repo_id.
+        self._quiet_sizes: Dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds: Dict[str, List[float]] = defaultdict(list)
+
+    def _get(
+        self, repo_id: str, instance: int, own_keys: Set[Tuple[str, int]] = frozenset()
+    ) -> Any:
+        """Recognizer for (repo_id, instance), loaded if needed. own_keys are
+        the keys checked out by the caller, which do not decode yet."""
+        key = (repo_id, instance)
+        entry = self._lookup(key)
+        if entry is not None:
+            return entry.recognizer
+
+        with self._load_lock:
+            # Another session may have loaded it while we were waiting.
+            entry = self._lookup(key, count_hit=False)
+            if entry is not None:
+                return entry.recognizer
+
+            with self._lock:
+                num_checkouts = self._num_checkouts
+                quiet = self._checked_out <= own_keys
+            rss = _resident_bytes()
+            start = time.monotonic()
+            recognizer = self.loader(repo_id)
+            load_seconds = time.monotonic() - start
+            num_bytes = max(0, _resident_bytes() - rss)
+            with self._lock:
+                quiet = (
+                    quiet
+                    and num_checkouts == self._num_checkouts
+                    and self._checked_out <= own_keys
+                )
+                if quiet:
+                    self._quiet_sizes[repo_id] = num_bytes
+                else:
+                    num_bytes = self._quiet_sizes.get(repo_id, num_bytes)
+
+            logging.info(
+                f"Loaded {repo_id} (instance {instance}) in {load_seconds:.2f} s, "
+                f"{num_bytes / 2**20:.0f} MiB"
+            )
+
+            with self._lock:
+                self.misses += 1
+                self.load_seconds[repo_id].append(load_seconds)
+                self._entries[key] = _Entry(recognizer, num_bytes, load_seconds)
+                self._evict()
+
+        return recognizer
+
+    @contextmanager
+    def checkout(self, repo_id: str, num_instances: int = 1) -> Iterator[List[Any]]:
+        """Lend num_instances recognizers of repo_id for the with block.
+
+        Blocks until that many instances are free. Instances that are already
+        loaded are preferred over loading new ones.
+        """
+        num_instances = max(1, min(num_instances, self.max_instances_per_model))
+        with self._returned:
+            while True:
+                free = [
+                    (repo_id, i)
+                    for i in range(self.max_instances_per_model)
+                    if (repo_id, i) not in self._checked_out
+                ]
+                if len(free) >= num_instances:
+                    break
+                self._returned.wait()
+            free.sort(key=lambda key: key not in self._entries)
+            keys = free[:num_instances]
+            self._checked_out.update(keys)
+            self._num_checkouts += 1
+
+        try:
+            yield [self._get(*key, own_keys=set(keys)) for key in keys]
+        finally:
+            with self._returned:
+                self._checked_out.difference_update(keys)
+                self._returned.notify_all()
+
+    def _lookup(self, key: Tuple[str, int], count_hit: bool = True) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if count_hit:
+                    self.hits += 1
+            return entry
+
+    def _evict(self):
+        # The most recently loaded entry is always kept, even if it alone is
+        # over budget.
+        for key in list(self._entries)[:-1]:
+            if (
+                len(self._entries) <= self.max_entries
+                and self.resident_bytes() <= self.max_bytes
+            ):
+                break
+            if key in self._checked_out:
+                continue
+            del self._entries[key]
+            self.evictions += 1
+            logging.info(f"Evicted {key[0]} (instance {key[1]})")
+
+    def resident_bytes(self) -> int:
+        return sum(e.num_bytes for e in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident_bytes": self.resident_bytes(),
+                "loaded": [f"{r}#{i}" for r, i in self._entries],
+                "checked_out": sorted(f"{r}#{i}" for r, i in self._checked_out),
+                "load_seconds": {
+                    r: sum(t) / len(t) for r, t in self.load_seconds.items()
+                },
+            }
+
+    def _read_usage(self) -> Dict[str, int]:
+        try:
+            with open(self.usage_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def record_use(self, repo_id: str):
+        """Count a choice of repo_id by a user.
+
+        Called by the UI when a user starts a transcription, not on every
+        checkout, so that batch workers and retries neither skew the counts
+        nor write the file on their hot path.
+        """
+        if self.usage_path is None:
+            return
+
+        with self._lock:
+            usage = self._read_usage()
+            usage[repo_id] = usage.get(repo_id, 0) + 1
+
+            self.usage_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.usage_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(usage, f)
+            os.replace(tmp, self.usage_path)
+
+    def most_used(self, n: int) -> List[str]:
+        if self.usage_path is None:
+            return []
+        usage = self._read_usage()
+        return sorted(usage, key=usage.get, reverse=True)[:n]
+
+    def preload(self, repo_ids: List[str]) -> threading.Thread:
+        """Load repo_ids in a background thread, most important first."""
+
+        def run():
+            for repo_id in repo_ids:
+                try:
+                    self._get(repo_id, 0)
+                except Exception:
+                    logging.exception(f"Failed to preload {repo_id}")
+
+        thread = threading.Thread(target=run, name="recognizer-preload", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,108 @@
+"""Upload media to S3 under content-addressed keys.
+
+Objects are keyed by the SHA-256 of their content, so a file never
+overwrites a different file that happens to have the same name, and one HEAD
+request is enough to skip a file that is already in the bucket. Files above
+multipart_threshold go up as concurrent multipart transfers. All uploads
+share one client and its connection pool.
+
+Nothing here depends on Streamlit, so it can be pointed at any S3 endpoint,
+e.g. a local moto server in tests and benchmarks/s3_upload.py.
+"""
+import os
+import threading
+from typing import Callable, Optional
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+max_concurrency = int(os.environ.get("SUBTITLE_S3_CONCURRENCY", "10"))
+
+transfer_config = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=max_concurrency,
+    use_threads=True,
+)
+
+
+def create_client(
+    region: str,
+    access_key: Optional[str] = None,
+    secret_key: Optional[str] = None,
+    endpoint_url: Optional[str] = None,
+):
+    # boto3 clients are thread-safe, so one client and its connection pool
+    # serve all parts of all uploads.
+    return boto3.client(
+        service_name="s3",
+        region_name=region,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=2 * max_concurrency,
+            retries={"max_attempts": 5, "mode": "adaptive"},
+        ),
+    )
+
+
+def content_key(sha256: str, suffix: str = "") -> str:
+    return f"media/{sha256}{suffix}"
+
+
+def public_url(region: str, bucket: str, key: str) -> str:
+    return "https://s3-%s.amazonaws.com/%s/%s" % (region, bucket, key)
+
+
+def exists(client, bucket: str, key: str) -> bool:
+    try:
+        client.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+
+class Progress:
+    """Upload progress callback that can be read from another thread."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, num_bytes: int):
+        # Called from the transfer threads, once per chunk sent.
+        with self._lock:
+            self.sent += num_bytes
+
+    @property
+    def fraction(self) -> float:
+        return min(1.0, self.sent / self.total) if self.total else 1.0
+
+
+def upload(
+    client,
+    bucket: str,
+    filename: str,
+    key: str,
+    callback: Optional[Callable[[int], None]] = None,
+    config: TransferConfig = transfer_config,
+) -> bool:
+    """Upload filename as key unless the bucket already has it.
+
+    callback is called with the number of bytes sent since the last call;
+    for a skipped file it is called once with the whole size. Returns
+    whether the file was uploaded.
+    """
+    if exists(client, bucket, key):
+        if callback is not None:
+            callback(os.path.getsize(filename))
+        return False
+
+    client.upload_file(filename, bucket, key, Callback=callback, Config=config)
+    return True
@@ -0,0 +1,169 @@
+"""Columnar storage for recognized segments.
+
+Start times and durations are NumPy arrays, and all texts share one UTF-8
+buffer indexed by an offsets array, laid out like an Arrow large_string
+array. WebVTT/SRT is written from these columns by
+subtitle_writer.write_cue_columns(), without a Python object per cue. The
+pandas DataFrame for the data editor does hold a datetime.time per start and
+end, since that is what the editor's time columns take.
+"""
+import io
+from typing import Iterable, List, TextIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from subtitle_writer import (
+    format_cue_column,
+    seconds_to_ms_array,
+    write_cue_columns,
+)
+
+_string = pa.large_string()
+
+
+def _text_buffers(texts: pa.Array):
+    """Return the (offsets, data) of a large_string array, rebased to 0."""
+    texts = pc.fill_null(texts.cast(_string), "")
+    _, offsets, data = texts.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[
+        texts.offset : texts.offset + len(texts) + 1
+    ]
+    data = b"" if data is None else data.to_pybytes()[offsets[0] : offsets[-1]]
+    return offsets - offsets[0], data
+
+
+class SegmentTable:
+    __slots__ = ("start", "duration", "text_offsets", "text_data")
+
+    def __init__(
+        self,
+        start: np.ndarray,
+        duration: np.ndarray,
+        text_offsets: np.ndarray,
+        text_data: bytes,
+    ):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.duration = np.asarray(duration, dtype=np.float64)
+        self.text_offsets = np.asarray(text_offsets, dtype=np.int64)
+        self.text_data = text_data
+        assert len(self.start) == len(self.duration) == len(self.text_offsets) - 1
+
+    @classmethod
+    def from_texts(
+        cls, start: np.ndarray, duration: np.ndarray, texts: pa.Array
+    ) -> "SegmentTable":
+        offsets, data = _text_buffers(texts)
+        return cls(start, duration, offsets, data)
+
+    @classmethod
+    def from_segments(cls, segments: Iterable) -> "SegmentTable":
+        segments = list(segments)
+        return cls.from_texts(
+            np.fromiter((s.start for s in segments), np.float64, len(segments)),
+            np.fromiter((s.duration for s in segments), np.float64, len(segments)),
+            pa.array([s.text for s in segments], type=_string),
+        )
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "SegmentTable":
+        """Inverse of to_dataframe(), e.g. for the output of st.data_editor."""
+        start = pa.array(df["start"], type=pa.time64("us")).cast(pa.int64())
+        end = pa.array(df["end"], type=pa.time64("us")).cast(pa.int64())
+        start = start.to_numpy(zero_copy_only=False) / 1e6
+        end = end.to_numpy(zero_copy_only=False) / 1e6
+        return cls.from_texts(start, end - start, pa.array(df["text"], type=_string))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    @property
+    def end(self) -> np.ndarray:
+        return self.start + self.duration
+
+    def texts(self) -> pa.Array:
+        return pa.LargeStringArray.from_buffers(
+            len(self),
+            pa.py_buffer(self.text_offsets),
+            pa.py_buffer(self.text_data),
+        )
+
+    def __getitem__(self, index) -> "SegmentTable":
+        """Select rows with a boolean mask, an index array or a slice."""
+        indices = np.arange(len(self))[index]
+        return SegmentTable.from_texts(
+            self.start[indices], self.duration[indices], self.texts().take(indices)
+        )
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """start and end as datetime.time with millisecond precision, and text,
+        as expected by the data editor."""
+        start = seconds_to_ms_array(self.start)
+        end = seconds_to_ms_array(self.end)
+        return pd.DataFrame(
+            {
+                "start": pd.to_datetime(start, unit="ms").time,
+                "end": pd.to_datetime(end, unit="ms").time,
+                "text": pd.arrays.ArrowStringArray(pa.chunked_array([self.texts()])),
+            }
+        )
+
+    def cue_strings(self, fmt: str = "vtt") -> List[str]:
+        """One serialized cue per row, for callers that patch single cues."""
+        separator = "." if fmt == "vtt" else ","
+        return format_cue_column(
+            1,
+            seconds_to_ms_array(self.start),
+            seconds_to_ms_array(self.end),
+            self.texts(),
+            separator,
+        ).to_pylist()
+
+    def write(self, out: TextIO, fmt: str = "vtt"):
+        """Write the table as fmt ("vtt" or "srt") to out, in chunks."""
+        write_cue_columns(
+            seconds_to_ms_array(self.start),
+            seconds_to_ms_array(self.end),
+            self.texts(),
+            out,
+            fmt,
+        )
+
+    def to_vtt(self) -> str:
+        return write_cue_columns(
+            seconds_to_ms_array(self.start),
+            seconds_to_ms_array(self.end),
+            self.texts(),
+            fmt="vtt",
+        )
+
+    def to_srt(self) -> str:
+        return write_cue_columns(
+            seconds_to_ms_array(self.start),
+            seconds_to_ms_array(self.end),
+            self.texts(),
+            fmt="srt",
+        )
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            start=self.start,
+            duration=self.duration,
+            text_offsets=self.text_offsets,
+            text_data=np.frombuffer(self.text_data, dtype=np.uint8),
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SegmentTable":
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(
+                arrays["start"],
+                arrays["duration"],
+                arrays["text_offsets"],
+                arrays["text_data"].tobytes(),
+            )
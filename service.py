@@ -0,0 +1,298 @@
+"""Serve subtitles over HTTP, batching recognition across requests.
+
+Usage:
+
+    python service.py [--host 127.0.0.1] [--port 8000] [--max-batch-size 32]
+        [--max-wait-ms 20] [--preload whisper-tiny.en ...]
+
+Endpoints:
+
+    POST /transcribe?model=<repo_id>[&format=vtt|srt][&url=<URL>][&cache=0]
+        Returns the subtitles of the media in the request body, or of the
+        http(s) URL given as url. cache=0 bypasses the transcript cache.
+    GET /models
+    GET /metrics
+
+Every request runs ffmpeg and the VAD in its own thread, but does not decode
+its speech segments itself. They are queued per model, and batcher threads
+drain each queue into decode_streams calls of up to max_batch_size segments,
+from whichever requests they come from. Once a segment is queued, a batcher
+waits at most max_wait for more to arrive. Under many small concurrent
+requests the recognizers thus decode full batches instead of one small
+batch per request.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+from urllib.parse import parse_qs, urlsplit
+
+import metrics
+from decode import Segment, _decode_batch, vad_windows
+from ingest import remove_stale_uploads, spool
+from model import (
+    checkout_recognizers,
+    checkout_vad,
+    language_to_models,
+    num_decoders,
+    vad_pool,
+)
+from segment_table import SegmentTable
+from transcript_cache import get_transcript_cache
+
+supported_models = {m for models in language_to_models.values() for m in models}
+
+
+@dataclass
+class _Item:
+    segment: Segment
+    samples: List[float]
+    future: Future
+    queued: float
+
+
+class Batcher:
+    """Decodes the queued segments of one model in shared batches."""
+
+    def __init__(
+        self,
+        repo_id: str,
+        max_batch_size: int,
+        max_wait: float,
+        num_threads: int = num_decoders,
+    ):
+        self.repo_id = repo_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[_Item]" = queue.Queue()
+
+        # Each thread checks out its own recognizer per batch.
+        for i in range(max(1, num_threads)):
+            threading.Thread(
+                target=self._run, name=f"batcher-{repo_id}-{i}", daemon=True
+            ).start()
+
+    def submit(
+        self, segments: List[Segment], samples: Sequence[Sequence[float]]
+    ) -> List[Future]:
+        """Queue segments for recognition; each future resolves to its
+        segment, with the text filled in."""
+        futures = []
+        now = time.perf_counter()
+        for segment, s in zip(segments, samples):
+            future = Future()
+            self._queue.put(_Item(segment, s, future, now))
+            futures.append(future)
+        return futures
+
+    def _next_batch(self) -> List[_Item]:
+        items = [self._queue.get()]
+        deadline = items[0].queued + self.max_wait
+        while len(items) < self.max_batch_size:
+            try:
+                items.append(
+                    self._queue.get(timeout=max(0, deadline - time.perf_counter()))
+                )
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+
+            run = metrics.start_run("batch", model=self.repo_id)
+            run.observe("batch_size", len(items))
+            try:
+                with checkout_recognizers(self.repo_id, 1) as (recognizer,):
+                    _decode_batch(
+                        recognizer,
+                        [item.segment for item in items],
+                        [item.samples for item in items],
+                        run=run,
+                        submitted=items[0].queued,
+                    )
+            except Exception as e:
+                logging.exception(f"Failed to decode a batch of {self.repo_id}")
+                for item in items:
+                    item.future.set_exception(e)
+            else:
+                for item in items:
+                    item.future.set_result(item.segment)
+            finally:
+                run.finish()
+
+
+class TranscriptionService:
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._batchers: Dict[str, Batcher] = {}
+        self._lock = threading.Lock()
+
+    def batcher(self, repo_id: str) -> Batcher:
+        with self._lock:
+            if repo_id not in self._batchers:
+                self._batchers[repo_id] = Batcher(
+                    repo_id, self.max_batch_size, self.max_wait
+                )
+            return self._batchers[repo_id]
+
+    def transcribe(
+        self,
+        repo_id: str,
+        source: str,
+        file_hash: Optional[str] = None,
+        use_cache: bool = True,
+    ) -> SegmentTable:
+        if repo_id not in supported_models:
+            raise ValueError(f"Unsupported model: {repo_id}")
+
+        transcript_cache = get_transcript_cache()
+        if file_hash and use_cache:
+            table = transcript_cache.get(file_hash, repo_id)
+            if table is not None:
+                return table
+
+        run = metrics.start_run("service", model=repo_id)
+        batcher = self.batcher(repo_id)
+        segments = []
+        futures = []
+        # The VAD is returned as soon as the file is split, before the
+        # segments are recognized.
+        with checkout_vad() as vad:
+            for _, window_segments, window_samples in vad_windows(
+                vad, source, run=run
+            ):
+                segments.extend(window_segments)
+                futures.extend(batcher.submit(window_segments, window_samples))
+        for future in futures:
+            future.result()
+        run.finish()
+
+        table = SegmentTable.from_segments(segments)
+        if file_hash:
+            transcript_cache.put(file_hash, repo_id, table)
+        return table
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send(self, body: bytes, content_type: str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/models":
+            self._send(
+                json.dumps(sorted(supported_models)).encode("utf-8"),
+                "application/json",
+            )
+        elif path == "/metrics":
+            self._send(
+                metrics.registry.render().encode("utf-8"),
+                "text/plain; version=0.0.4",
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/transcribe":
+            self.send_error(404)
+            return
+
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        repo_id = params.get("model", "")
+        fmt = params.get("format", "vtt")
+        media_url = params.get("url")
+        use_cache = params.get("cache", "1") != "0"
+
+        if repo_id not in supported_models:
+            self.send_error(400, "Unsupported model", repo_id)
+            return
+        if fmt not in ("vtt", "srt"):
+            self.send_error(400, "Unsupported format", fmt)
+            return
+        # ffmpeg would also open local files and other protocols.
+        if media_url is not None and urlsplit(media_url).scheme not in ("http", "https"):
+            self.send_error(400, "url must be an http or https URL")
+            return
+
+        length = None
+        if media_url is None:
+            length = self.headers.get("Content-Length")
+            if length is None:
+                self.send_error(411)
+                return
+            if not length.strip().isdigit():
+                self.send_error(400, "Invalid Content-Length", length)
+                return
+            length = int(length)
+
+        service: TranscriptionService = self.server.service
+        try:
+            if media_url is not None:
+                table = service.transcribe(repo_id, media_url, use_cache=use_cache)
+            else:
+                remove_stale_uploads()
+                ingested = spool(self.rfile, size=length)
+                table = service.transcribe(
+                    repo_id, ingested.path, ingested.sha256, use_cache
+                )
+        except Exception as e:
+            logging.exception(f"Failed to transcribe for {self.client_address}")
+            self.send_error(500, "Transcription failed", str(e))
+            return
+
+        body = table.to_vtt() if fmt == "vtt" else table.to_srt()
+        self._send(body.encode("utf-8"), f"text/{fmt}; charset=utf-8")
+
+    def log_message(self, format, *args):
+        logging.info(f"{self.address_string()} {format % args}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument(
+        "--vad-pool-size",
+        type=int,
+        default=max(vad_pool.max_size, 4 * (os.cpu_count() or 1)),
+        help="number of requests that run ffmpeg and the VAD at a time",
+    )
+    parser.add_argument("--preload", nargs="*", default=[])
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    vad_pool.max_size = args.vad_pool_size
+
+    service = TranscriptionService(args.max_batch_size, args.max_wait_ms / 1000)
+    for repo_id in args.preload:
+        with checkout_recognizers(repo_id, 1):
+            logging.info(f"Preloaded {repo_id}")
+
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    logging.info(f"Listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
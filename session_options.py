@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import platform
+import threading
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+
+@dataclass
+class SessionOptions:
+    num_threads: int = 2
+    # Maximum number of segments per decode_streams call, None for no limit.
+    batch_size: Optional[int] = None
+
+
+def cpu_signature() -> str:
+    """Identify the kind of host, so that tuned options are not reused on
+    different hardware."""
+    model_name = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    model_name = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return f"{platform.machine()}|{model_name}|{os.cpu_count()}"
+
+
+class SessionOptionsStore:
+    """Per-model recognizer options.
+
+    Options come from, in order of precedence: the overrides file (a JSON
+    object mapping repo_id, or "*" for all models, to SessionOptions fields),
+    the tuned options saved for this host by tune.py, and the defaults.
+    """
+
+    def __init__(self, path: Path, overrides_path: Optional[Path] = None):
+        self.path = Path(path)
+        self.overrides_path = overrides_path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _read(path: Optional[Path]) -> Dict[str, Dict]:
+        if path is None:
+            return {}
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logging.exception(f"Ignoring unreadable session options {path}")
+            return {}
+
+    @staticmethod
+    def _key(repo_id: str) -> str:
+        return f"{repo_id}|{cpu_signature()}"
+
+    def get(self, repo_id: str) -> SessionOptions:
+        options = dict(self._read(self.path).get(self._key(repo_id), {}))
+        overrides = self._read(self.overrides_path)
+        options.update(overrides.get("*", {}))
+        options.update(overrides.get(repo_id, {}))
+
+        fields = SessionOptions.__dataclass_fields__
+        return SessionOptions(**{k: v for k, v in options.items() if k in fields})
+
+    def put(self, repo_id: str, options: SessionOptions, **extra):
+        """Save tuned options for repo_id on this host. extra is stored
+        alongside for reference, e.g. the measured real-time factor."""
+        with self._lock:
+            tuned = self._read(self.path)
+            tuned[self._key(repo_id)] = {**asdict(options), **extra}
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(tuned, f, indent=2)
+            os.replace(tmp, self.path)
@@ -0,0 +1,111 @@
+"""Transcribe long files by decoding overlapping time shards in parallel.
+
+The timeline is cut into shards of shard_seconds. Each worker process runs
+its own ffmpeg/VAD/recognizer pipeline over one shard, extended by overlap
+seconds on both sides, and keeps only the segments that start inside the
+shard itself. The lead-in lets the VAD settle before the shard starts, so
+away from shard boundaries the result is the same as decode.decode_segments.
+
+Tolerance: within overlap seconds of a shard boundary a cue may be split or
+merged differently than in a single pass, and a cue that straddles a boundary
+and is longer than overlap may be dropped. Cues that would overlap the last
+kept cue of the previous shard are discarded as duplicates.
+"""
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from audio_source import probe_duration
+from decode import Segment, decode_segments
+
+default_overlap = 30  # seconds
+
+# Files shorter than this are decoded in a single shard.
+min_shard_seconds = 300
+
+
+def _decode_shard(
+    repo_id: str, filename: str, start: float, end: float, overlap: float
+) -> List[Segment]:
+    # Imported here so the models are only loaded in the worker processes.
+    from model import checkout_recognizers, checkout_vad, session_options
+
+    read_start = max(0, start - overlap)
+    duration = None
+    if end != math.inf:
+        duration = end + overlap - read_start
+
+    with checkout_recognizers(repo_id, 1) as recognizers, checkout_vad() as vad:
+        segments = decode_segments(
+            recognizers,
+            vad,
+            filename,
+            start=read_start,
+            duration=duration,
+            max_batch_size=session_options.get(repo_id).batch_size,
+        )
+        return [s for s in segments if start <= s.start < end]
+
+
+def merge_shards(shards: List[List[Segment]]) -> List[Segment]:
+    merged = []
+    for segments in shards:
+        for s in segments:
+            if merged and s.start < merged[-1].end:
+                continue
+            merged.append(s)
+    return merged
+
+
+def decode_sharded(
+    repo_id: str,
+    filename: str,
+    num_workers: Optional[int] = None,
+    shard_seconds: Optional[float] = None,
+    overlap: float = default_overlap,
+) -> List[Segment]:
+    """Decode filename with repo_id using a pool of num_workers processes.
+
+    By default there is one shard per worker, but no shorter than
+    min_shard_seconds.
+    """
+    if num_workers is None:
+        from model import session_options
+
+        # Each recognizer already runs with its tuned number of threads.
+        num_threads = session_options.get(repo_id).num_threads
+        num_workers = max(1, (os.cpu_count() or 1) // num_threads)
+
+    total = probe_duration(filename)
+    if shard_seconds is None:
+        shard_seconds = max(min_shard_seconds, total / num_workers)
+
+    num_shards = max(1, math.ceil(total / shard_seconds))
+    bounds = [
+        (i * shard_seconds, min(total, (i + 1) * shard_seconds))
+        for i in range(num_shards)
+    ]
+    # The last shard must also keep segments that start exactly at the end.
+    bounds[-1] = (bounds[-1][0], math.inf)
+
+    logging.info(
+        f"Decoding {filename} ({total:.1f} s) in {num_shards} shards "
+        f"with {num_workers} workers"
+    )
+
+    # Worker processes are spawned, since forking a process that runs
+    # Streamlit and ONNX Runtime threads is not safe.
+    with ProcessPoolExecutor(
+        max_workers=min(num_workers, num_shards),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as executor:
+        futures = [
+            executor.submit(_decode_shard, repo_id, filename, start, end, overlap)
+            for start, end in bounds
+        ]
+        shards = [f.result() for f in futures]
+
+    return merge_shards(shards)
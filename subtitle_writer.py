@@ -0,0 +1,198 @@
+"""Write subtitles as WebVTT or SRT in one buffered pass.
+
+Cues are (start_ms, end_ms, text) triples. Helpers convert decode.Segment
+objects and data editor records into cues. Output goes either to a string or
+to any object with a write() method, e.g. an open file or socket.makefile().
+
+write_cue_columns() writes the same output from columns, a NumPy array per
+timestamp and a pyarrow array of texts, with pyarrow.compute and without a
+Python object per cue; segment_table.SegmentTable uses it.
+"""
+import threading
+from datetime import time
+from typing import Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+Cue = Tuple[int, int, str]
+
+# Number of cues formatted before each write() when streaming to a file.
+_chunk_size = 1024
+# The same for write_cue_columns(), which has less overhead per chunk.
+_column_chunk_size = 65536
+
+_string = pa.large_string()
+
+_millis = [f"{ms:03d}" for ms in range(1000)]
+_hms_cache: List[str] = []
+# Serializes growing _hms_cache; lookups of seconds already in it need no lock.
+_hms_lock = threading.Lock()
+
+
+def _hms(seconds: int) -> str:
+    # Timestamps are mostly increasing and bounded by the file duration, so a
+    # table indexed by whole seconds is small and turns formatting into two
+    # lookups and a concatenation.
+    if seconds >= len(_hms_cache):
+        with _hms_lock:
+            first = len(_hms_cache)
+            _hms_cache.extend(
+                f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}"
+                for s in range(first, seconds + 1)
+            )
+    return _hms_cache[seconds]
+
+
+def format_timestamp(ms: int, separator: str = ".") -> str:
+    """Format milliseconds as HH:MM:SS.mmm, or HH:MM:SS,mmm for SRT."""
+    return _hms(ms // 1000) + separator + _millis[ms % 1000]
+
+
+def seconds_to_ms(seconds: float) -> int:
+    # Round to microseconds first, like datetime.timedelta, then truncate.
+    return round(seconds * 1_000_000) // 1000
+
+
+def seconds_to_ms_array(seconds: np.ndarray) -> np.ndarray:
+    """seconds_to_ms() of a whole column; rounds half to even like round()."""
+    return np.round(seconds * 1_000_000).astype(np.int64) // 1000
+
+
+def time_to_ms(t: time) -> int:
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000 + t.microsecond // 1000
+
+
+def segment_cues(segments: Iterable) -> Iterator[Cue]:
+    for s in segments:
+        yield seconds_to_ms(s.start), seconds_to_ms(s.start + s.duration), s.text
+
+
+def record_cues(records: Iterable[Dict]) -> Iterator[Cue]:
+    for r in records:
+        yield time_to_ms(r["start"]), time_to_ms(r["end"]), r["text"]
+
+
+def format_cue(index: int, start: int, end: int, text: str, separator: str = ".") -> str:
+    text = text.replace("\n", " ")
+    return (
+        f"{index}\n"
+        f"{_hms(start // 1000)}{separator}{_millis[start % 1000]} --> "
+        f"{_hms(end // 1000)}{separator}{_millis[end % 1000]}\n"
+        f"{text}\n\n"
+    )
+
+
+def _format(cues: Iterable[Cue], fmt: str) -> Iterator[str]:
+    separator = "." if fmt == "vtt" else ","
+    if fmt == "vtt":
+        yield "WEBVTT\n\n"
+    for i, (start, end, text) in enumerate(cues, 1):
+        yield format_cue(i, start, end, text, separator)
+
+
+def write_subtitles(
+    cues: Iterable[Cue], out: Optional[TextIO] = None, fmt: str = "vtt"
+) -> Optional[str]:
+    """Write cues as fmt ("vtt" or "srt") to out, or return them as a string
+    if out is None."""
+    assert fmt in ("vtt", "srt"), fmt
+
+    if out is None:
+        return "".join(_format(cues, fmt))
+
+    chunk = []
+    for s in _format(cues, fmt):
+        chunk.append(s)
+        if len(chunk) == _chunk_size:
+            out.write("".join(chunk))
+            chunk.clear()
+    out.write("".join(chunk))
+    return None
+
+
+def segments_to_vtt(segments: Iterable) -> str:
+    return write_subtitles(segment_cues(segments), fmt="vtt")
+
+
+def segments_to_srt(segments: Iterable) -> str:
+    return write_subtitles(segment_cues(segments), fmt="srt")
+
+
+def records_to_vtt(records: Iterable[Dict]) -> str:
+    return write_subtitles(record_cues(records), fmt="vtt")
+
+
+def _join(strings: pa.Array) -> str:
+    """Concatenate all strings of a large_string array."""
+    _, offsets, data = strings.buffers()
+    if data is None:
+        return ""
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    first, last = offsets[strings.offset], offsets[strings.offset + len(strings)]
+    return memoryview(data)[first:last].tobytes().decode("utf-8")
+
+
+def _timestamp_column(ms: np.ndarray, separator: str) -> pa.Array:
+    """format_timestamp() of a whole column."""
+
+    def pad(values, width):
+        return pc.utf8_lpad(pc.cast(pa.array(values), _string), width, "0")
+
+    hms = pc.binary_join_element_wise(
+        pad(ms // 3600000, 2),
+        pad(ms // 60000 % 60, 2),
+        pad(ms // 1000 % 60, 2),
+        pa.scalar(":", _string),
+    )
+    return pc.binary_join_element_wise(
+        hms, pad(ms % 1000, 3), pa.scalar(separator, _string)
+    )
+
+
+def format_cue_column(
+    first_index: int,
+    start: np.ndarray,
+    end: np.ndarray,
+    texts: pa.Array,
+    separator: str = ".",
+) -> pa.Array:
+    """format_cue() of whole columns, numbered from first_index."""
+    index = pc.cast(pa.array(np.arange(first_index, first_index + len(start))), _string)
+    texts = pc.replace_substring(pc.fill_null(texts.cast(_string), ""), "\n", " ")
+    timing = pc.binary_join_element_wise(
+        _timestamp_column(start, separator),
+        _timestamp_column(end, separator),
+        pa.scalar(" --> ", _string),
+    )
+    empty = pa.scalar("", _string)
+    return pc.binary_join_element_wise(
+        index, timing, texts, empty, empty, pa.scalar("\n", _string)
+    )
+
+
+def write_cue_columns(
+    start: np.ndarray,
+    end: np.ndarray,
+    texts: pa.Array,
+    out: Optional[TextIO] = None,
+    fmt: str = "vtt",
+) -> Optional[str]:
+    """write_subtitles() of cues given as columns: start and end in
+    milliseconds, see seconds_to_ms_array(), and their texts."""
+    assert fmt in ("vtt", "srt"), fmt
+    separator = "." if fmt == "vtt" else ","
+    header = "WEBVTT\n\n" if fmt == "vtt" else ""
+
+    if out is None:
+        return header + _join(format_cue_column(1, start, end, texts, separator))
+
+    out.write(header)
+    for first in range(0, len(start), _column_chunk_size):
+        last = min(first + _column_chunk_size, len(start))
+        cues = format_cue_column(
+            first + 1, start[first:last], end[first:last], texts[first:last], separator
+        )
+        out.write(_join(cues))
+    return None
@@ -0,0 +1,187 @@
+"""AssemblyAIJobs against a local mock of the AssemblyAI REST API.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import json
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from assemblyai_jobs import AssemblyAIClient, AssemblyAIJobs, VttCache
+
+vtt = "WEBVTT\n\n1\n00:00:00.000 --> 00:00:01.000\nHello\n\n"
+
+
+class MockAssemblyAI(ThreadingHTTPServer):
+    """Serves transcripts whose status advances by one step per poll.
+
+    statuses is the sequence of statuses returned by the polls of every
+    transcript; submit_errors and poll_errors are HTTP status codes returned
+    instead of the first requests of their kind.
+    """
+
+    def __init__(self, statuses, submit_errors=(), poll_errors=()):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.statuses = list(statuses)
+        self.submit_errors = list(submit_errors)
+        self.poll_errors = list(poll_errors)
+        self.lock = threading.Lock()
+        self.submits = []
+        # Times of the status requests, by transcript ID.
+        self.polls = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code: int, body: bytes, content_type="application/json"):
+        self.send_response(code)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        with server.lock:
+            if server.submit_errors:
+                return self._reply(server.submit_errors.pop(0), b"{}")
+            transcript_id = f"t{len(server.submits)}"
+            server.submits.append(body["audio_url"])
+            server.polls[transcript_id] = []
+        self._reply(200, json.dumps({"id": transcript_id}).encode())
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip("/").split("/")
+        transcript_id = parts[2]
+        if parts[3:] == ["vtt"]:
+            return self._reply(200, vtt.encode(), "text/vtt")
+
+        with server.lock:
+            if server.poll_errors:
+                return self._reply(server.poll_errors.pop(0), b"{}")
+            polls = server.polls[transcript_id]
+            polls.append(time.monotonic())
+            status = server.statuses[min(len(polls), len(server.statuses)) - 1]
+        transcript = {"id": transcript_id, "status": status}
+        if status == "error":
+            transcript["error"] = "Audio file is empty"
+        self._reply(200, json.dumps(transcript).encode())
+
+
+def wait_done(job, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not job.done:
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Job still {job.state} after {timeout} s")
+        time.sleep(0.01)
+    return job
+
+
+class AssemblyAIJobsTest(unittest.TestCase):
+    def start(self, server, max_poll_interval=0.2):
+        threading.Thread(
+            target=server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.cache = VttCache(tmp.name)
+        return self.new_jobs(server, max_poll_interval)
+
+    def new_jobs(self, server, max_poll_interval=0.2):
+        return AssemblyAIJobs(
+            AssemblyAIClient("key", server.url, timeout=5),
+            self.cache,
+            max_concurrency=2,
+            poll_interval=0.05,
+            max_poll_interval=max_poll_interval,
+        )
+
+    def test_submit_polls_until_completed(self):
+        server = MockAssemblyAI(["queued", "processing", "processing", "completed"])
+        jobs = self.start(server)
+
+        job = jobs.submit("hash", "https://example.com/a.mp4")
+        self.assertEqual(wait_done(job).state, "completed")
+        self.assertEqual(job.vtt, vtt)
+        self.assertEqual(job.transcript_id, "t0")
+        self.assertEqual(job.polls, 4)
+        self.assertEqual(server.submits, ["https://example.com/a.mp4"])
+        self.assertEqual(self.cache.get("hash"), vtt)
+
+    def test_polls_back_off(self):
+        server = MockAssemblyAI(["processing"] * 7 + ["completed"])
+        jobs = self.start(server, max_poll_interval=0.15)
+
+        wait_done(jobs.submit("hash", "https://example.com/a.mp4"))
+        times = server.polls["t0"]
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        # 0.05 * 1.5 ** n, capped at max_poll_interval.
+        self.assertGreater(gaps[2], gaps[0] * 1.5)
+        self.assertLess(max(gaps), 0.15 + 0.1)
+        self.assertGreater(gaps[-1], 0.15 - 0.02)
+
+    def test_error_status(self):
+        server = MockAssemblyAI(["queued", "error"])
+        jobs = self.start(server)
+
+        job = wait_done(jobs.submit("hash", "https://example.com/a.mp4"))
+        self.assertEqual(job.state, "error")
+        self.assertEqual(job.error, "Audio file is empty")
+        self.assertIsNone(self.cache.get("hash"))
+
+    def test_transient_errors_are_retried(self):
+        server = MockAssemblyAI(
+            ["completed"], submit_errors=[503, 429], poll_errors=[500]
+        )
+        jobs = self.start(server)
+
+        job = wait_done(jobs.submit("hash", "https://example.com/a.mp4"))
+        self.assertEqual(job.state, "completed")
+        self.assertEqual(len(server.submits), 1)
+
+    def test_client_error_fails_at_once(self):
+        server = MockAssemblyAI(["completed"], submit_errors=[400])
+        jobs = self.start(server)
+
+        job = wait_done(jobs.submit("hash", "https://example.com/a.mp4"))
+        self.assertEqual(job.state, "error")
+        self.assertIn("400", job.error)
+        self.assertEqual(job.errors, 1)
+
+        # A failed job may be submitted again.
+        retried = jobs.submit("hash", "https://example.com/a.mp4")
+        self.assertIsNot(retried, job)
+        self.assertEqual(wait_done(retried).state, "completed")
+
+    def test_same_media_is_transcribed_once(self):
+        server = MockAssemblyAI(["processing", "completed"])
+        jobs = self.start(server)
+
+        first = jobs.submit("hash", "https://example.com/a.mp4")
+        # Another upload of the same content gets the job in progress.
+        self.assertIs(jobs.submit("hash", "https://example.com/b.mp4"), first)
+        wait_done(first)
+        self.assertIs(jobs.submit("hash", "https://example.com/a.mp4"), first)
+
+        # After a restart, the result comes from the cache.
+        restarted = self.new_jobs(server)
+        job = restarted.submit("hash", "https://example.com/a.mp4")
+        self.assertEqual(job.state, "completed")
+        self.assertEqual(job.vtt, vtt)
+        self.assertEqual(server.submits, ["https://example.com/a.mp4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
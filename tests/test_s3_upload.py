@@ -0,0 +1,108 @@
+"""s3_upload against moto's in-process S3, skipped if moto is not installed.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import hashlib
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+try:
+    from boto3.s3.transfer import TransferConfig
+    from botocore.stub import Stubber
+    from moto import mock_aws
+
+    import s3_upload
+except ImportError:
+    mock_aws = None
+
+region = "us-east-1"
+bucket = "subtitle-demo-test"
+
+
+@unittest.skipIf(mock_aws is None, "moto and boto3 are not installed")
+class S3UploadTest(unittest.TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        self.client = s3_upload.create_client(region, "testing", "testing")
+        self.client.create_bucket(Bucket=bucket)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = Path(tmp.name)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = self.tmp / name
+        path.write_bytes(data)
+        return str(path)
+
+    def test_key_is_the_content_hash(self):
+        data = b"same content"
+        sha256 = hashlib.sha256(data).hexdigest()
+        key = s3_upload.content_key(sha256, ".mp4")
+        self.assertEqual(key, f"media/{sha256}.mp4")
+
+        self.assertTrue(
+            s3_upload.upload(self.client, bucket, self.write("a.mp4", data), key)
+        )
+        body = self.client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        self.assertEqual(body, data)
+
+    def test_existing_object_is_skipped(self):
+        data = b"x" * 1000
+        key = s3_upload.content_key(hashlib.sha256(data).hexdigest(), ".mp4")
+        s3_upload.upload(self.client, bucket, self.write("a.mp4", data), key)
+
+        # Another file name with the same content maps to the same key.
+        calls = []
+        uploaded = s3_upload.upload(
+            self.client, bucket, self.write("b.mp4", data), key, calls.append
+        )
+        self.assertFalse(uploaded)
+        self.assertEqual(calls, [len(data)])
+
+    def test_multipart_upload(self):
+        # S3 parts other than the last must be at least 5 MiB.
+        part_size = 5 * 1024 * 1024
+        data = os.urandom(2 * part_size + 1000)
+        config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=3,
+        )
+        progress = s3_upload.Progress(len(data))
+
+        uploaded = s3_upload.upload(
+            self.client,
+            bucket,
+            self.write("long.mp4", data),
+            "media/long.mp4",
+            progress,
+            config,
+        )
+        self.assertTrue(uploaded)
+        self.assertEqual(progress.sent, len(data))
+        self.assertEqual(progress.fraction, 1.0)
+
+        head = self.client.head_object(Bucket=bucket, Key="media/long.mp4")
+        # The ETag of a multipart object ends with the number of parts.
+        self.assertTrue(head["ETag"].strip('"').endswith("-3"), head["ETag"])
+        body = self.client.get_object(Bucket=bucket, Key="media/long.mp4")
+        self.assertEqual(body["Body"].read(), data)
+
+    def test_exists(self):
+        self.assertFalse(s3_upload.exists(self.client, bucket, "media/missing"))
+
+        with Stubber(self.client) as stubber:
+            stubber.add_client_error(
+                "head_object", service_error_code="403", http_status_code=403
+            )
+            with self.assertRaises(s3_upload.ClientError):
+                s3_upload.exists(self.client, bucket, "media/forbidden")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+
+from decode import decoder_version
+from model import cache_dir, vad_config_id
+from segment_table import SegmentTable
+
+# Upper bound for the size of all stored transcripts together.
+max_transcript_cache_bytes = int(
+    os.environ.get("SUBTITLE_TRANSCRIPT_CACHE_BYTES", 256 * 1024 * 1024)
+)
+
+
+class TranscriptCache:
+    """On-disk LRU cache of recognized segments.
+
+    Entries are keyed by file hash, model, VAD settings and decoder version.
+    The cache is a SQLite database in WAL mode, so any number of threads and
+    processes can read and write it at the same time.
+    """
+
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS segment_tables ("
+                " key TEXT PRIMARY KEY,"
+                " data BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS segment_tables_last_access"
+                " ON segment_tables (last_access)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # One short-lived connection per call: sqlite3 connections must not be
+        # shared between the threads Streamlit runs sessions in.
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def key(file_hash: str, repo_id: str) -> str:
+        return f"{file_hash}:{repo_id}:{vad_config_id}:{decoder_version}"
+
+    def get(self, file_hash: str, repo_id: str) -> Optional[SegmentTable]:
+        key = self.key(file_hash, repo_id)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM segment_tables WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE segment_tables SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+
+        return SegmentTable.from_bytes(row[0])
+
+    def put(self, file_hash: str, repo_id: str, table: SegmentTable):
+        data = table.to_bytes()
+        size = len(data)
+        if size > self.max_bytes:
+            return
+
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO segment_tables VALUES (?, ?, ?, ?)",
+                (self.key(file_hash, repo_id), data, size, time.time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        (total,) = conn.execute("SELECT SUM(size) FROM segment_tables").fetchone()
+        if total <= self.max_bytes:
+            return
+
+        rows = conn.execute(
+            "SELECT key, size FROM segment_tables ORDER BY last_access"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM segment_tables WHERE key = ?", (key,))
+            total -= size
+
+
+@lru_cache(maxsize=1)
+def get_transcript_cache() -> TranscriptCache:
+    return TranscriptCache(cache_dir / "transcripts.sqlite3", max_transcript_cache_bytes)
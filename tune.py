@@ -0,0 +1,101 @@
+"""Find the fastest thread count and batch size per model on this host.
+
+Every candidate configuration decodes the VAD segments of a calibration clip.
+The fastest one is saved for this host's CPU signature and picked up by
+model.checkout_recognizers() and the pages from then on.
+
+Usage:
+
+    python tune.py [--models whisper-tiny.en ...] [--threads 1 2 4]
+        [--batch-sizes 1 4 16 0] [--clip example.mp4]
+
+A batch size of 0 means one decode_streams call per read window.
+"""
+import argparse
+import logging
+import os
+import time
+from typing import List
+
+from audio_source import read_pcm
+from decode import Segment, _decode_batch, vad_split
+from model import (
+    _load_pretrained_model,
+    checkout_vad,
+    language_to_models,
+    num_decoders,
+    sample_rate,
+    session_options,
+)
+from session_options import SessionOptions
+
+
+def calibration_segments(filename: str) -> List[List[float]]:
+    with checkout_vad() as vad:
+        _, samples = vad_split(vad, read_pcm(filename))
+    return samples
+
+
+def time_decode(recognizer, samples, batch_size: int) -> float:
+    segments = [Segment(0, len(s) / sample_rate) for s in samples]
+    start = time.perf_counter()
+    _decode_batch(recognizer, segments, samples, batch_size or None)
+    return time.perf_counter() - start
+
+
+def tune(repo_id: str, samples, threads: List[int], batch_sizes: List[int]):
+    audio_seconds = sum(len(s) for s in samples) / sample_rate
+
+    best = None
+    for num_threads in threads:
+        recognizer = _load_pretrained_model(repo_id, num_threads=num_threads)
+        # Warm up, the first run includes one-off allocations.
+        time_decode(recognizer, samples[:1], 1)
+
+        for batch_size in batch_sizes:
+            elapsed = time_decode(recognizer, samples, batch_size)
+            rtf = elapsed / audio_seconds
+            print(
+                f"{repo_id}: num_threads={num_threads} "
+                f"batch_size={batch_size or 'all'} RTF={rtf:.4f}"
+            )
+            if best is None or rtf < best[0]:
+                best = (rtf, num_threads, batch_size or None)
+
+        del recognizer
+
+    rtf, num_threads, batch_size = best
+    session_options.put(
+        repo_id, SessionOptions(num_threads, batch_size), rtf=round(rtf, 4)
+    )
+    print(f"{repo_id}: saved num_threads={num_threads} batch_size={batch_size}")
+
+
+def main():
+    # Leave room for the num_decoders recognizers that run side by side.
+    max_threads = max(1, (os.cpu_count() or 1) // num_decoders)
+    default_threads = [n for n in (1, 2, 4, 8, 16, 32) if n <= max_threads]
+
+    all_models = list(
+        dict.fromkeys(m for models in language_to_models.values() for m in models)
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--models", nargs="+", default=all_models)
+    parser.add_argument("--threads", nargs="+", type=int, default=default_threads)
+    parser.add_argument(
+        "--batch-sizes", nargs="+", type=int, default=[1, 4, 16, 0]
+    )
+    parser.add_argument("--clip", default="example.mp4")
+    args = parser.parse_args()
+
+    samples = calibration_segments(args.clip)
+    for repo_id in args.models:
+        try:
+            tune(repo_id, samples, args.threads, args.batch_sizes)
+        except Exception:
+            logging.exception(f"Failed to tune {repo_id}")
+
+
+if __name__ == "__main__":
+    main()
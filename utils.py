@@ -1,14 +1,35 @@
-import pandas as pd
+import re
 from datetime import datetime, time
-import webvtt
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
-import io
+
+from segment_table import SegmentTable
+
+from subtitle_writer import (
+    format_cue,
+    format_timestamp,
+    records_to_vtt,
+    seconds_to_ms_array,
+    time_to_ms,
+)
+
+# One match per cue: the start and end timestamps (hours are optional in
+# WebVTT, SRT uses a comma before the milliseconds) and the cue payload, which
+# runs up to the next blank line.
+_cue_re = re.compile(
+    r"^(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})[ \t]+-->[ \t]+"
+    r"(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})[^\n]*\n"
+    r"((?:[^\n]+(?:\n|\Z))*)",
+    re.MULTILINE,
+)
 
 
 def time_to_webvtt_timestamp(t: time):
     """Convert a datetime.time object to a WebVTT timestamp string."""
-    return f"{t.strftime('%H:%M:%S')}.000"
+    return format_timestamp(time_to_ms(t))
 
 
 def string_to_time(s: str):
@@ -16,40 +37,111 @@ def string_to_time(s: str):
     return datetime.strptime(s, "%H:%M:%S.%f").time()
 
 
+def _to_milliseconds(hours, minutes, seconds, millis) -> np.ndarray:
+    hours = np.where(hours == "", "0", hours).astype(np.int64)
+    return (
+        (hours * 60 + minutes.astype(np.int64)) * 60 + seconds.astype(np.int64)
+    ) * 1000 + millis.astype(np.int64)
+
+
+def segment_table_to_dataframe(table: SegmentTable) -> pd.DataFrame:
+    """Data editor rows for table. Cues of 100 ms or shorter are dropped."""
+    keep = seconds_to_ms_array(table.end) - seconds_to_ms_array(table.start) > 100
+    return table[keep].to_dataframe()
+
+
 def vtt_string_to_dataframe(vtt_string: str) -> pd.DataFrame:
-    time_epsilon = pd.Timedelta("00:00:00.1")
-
-    buffer = io.StringIO(vtt_string)
-
-    vtt = webvtt.read_buffer(buffer=buffer)
-
-    df = pd.DataFrame(
-        [
-            [
-                pd.to_datetime(v.start),
-                pd.to_datetime(v.end),
-                v.text.splitlines()[-1],
-            ]
-            for v in vtt
-        ],
-        columns=["start", "end", "text"],
+    """Parse WebVTT or SRT subtitles into start, end and text columns.
+
+    Start and end are datetime.time objects with millisecond precision, text
+    is the last line of each cue. Cues of 100 ms or shorter are dropped.
+    """
+    cues = _cue_re.findall(vtt_string.replace("\r\n", "\n"))
+    fields = np.array(cues, dtype=object).reshape(-1, 9).astype(str)
+
+    start = _to_milliseconds(*fields[:, 0:4].T)
+    end = _to_milliseconds(*fields[:, 4:8].T)
+    text = pd.Series(fields[:, 8]).str.rstrip("\n").str.rsplit("\n", n=1).str[-1]
+
+    table = SegmentTable.from_texts(
+        start / 1000, (end - start) / 1000, pa.array(text, type=pa.large_string())
     )
-    df = df.where(df.end - df.start > time_epsilon).dropna()
-    df["start"] = df["start"].apply(time_to_webvtt_timestamp)
-    df["end"] = df["end"].apply(time_to_webvtt_timestamp)
-    df["start"] = df["start"].apply(string_to_time)
-    df["end"] = df["end"].apply(string_to_time)
-    return df
+    return table[end - start > 100].to_dataframe()
+
+
+def dataframe_to_webvtt(df: pd.DataFrame) -> str:
+    return SegmentTable.from_dataframe(df).to_vtt()
 
 
 def data_to_webvtt(data) -> str:
-    webvtt_content = "WEBVTT\n\n"
+    return records_to_vtt(data)
+
+
+class EditableSubtitles:
+    """WebVTT for the rows of a data editor, kept up to date incrementally.
+
+    base is the DataFrame passed to st.data_editor. update() receives the
+    edited DataFrame and the editor's widget state, and re-serializes only
+    the rows whose entry in edited_rows differs from the previous update, so
+    the cost of an edit does not depend on the number of cues.
+    """
+
+    def __init__(self, base: pd.DataFrame):
+        self.base = base
+        self._cues = SegmentTable.from_dataframe(base).cue_strings("vtt")
+        self._edited_rows = {}
+        self._vtt = None
+        self._vtt_bytes = None
+
+    def update(self, edited_df: pd.DataFrame, editor_state: dict) -> bool:
+        """Apply the edits in editor_state, return whether the VTT changed."""
+        if editor_state.get("added_rows") or editor_state.get("deleted_rows"):
+            # Cue numbers shift, start over from the edited rows.
+            cues = SegmentTable.from_dataframe(edited_df).cue_strings("vtt")
+            changed = cues != self._cues
+            self._cues = cues
+            self._edited_rows = None
+        else:
+            edited_rows = {
+                int(row): dict(values)
+                for row, values in editor_state.get("edited_rows", {}).items()
+            }
+            if self._edited_rows is None:
+                rows = range(len(edited_df))
+            else:
+                rows = [
+                    row
+                    for row in edited_rows.keys() | self._edited_rows.keys()
+                    if edited_rows.get(row) != self._edited_rows.get(row)
+                ]
+            self._edited_rows = edited_rows
+
+            changed = False
+            for row in rows:
+                start, end, text = edited_df.iloc[row][["start", "end", "text"]]
+                # Cleared cells come back as missing values.
+                cue = format_cue(
+                    row + 1,
+                    0 if pd.isna(start) else time_to_ms(start),
+                    0 if pd.isna(end) else time_to_ms(end),
+                    "" if pd.isna(text) else text,
+                )
+                if cue != self._cues[row]:
+                    self._cues[row] = cue
+                    changed = True
 
-    for index, entry in enumerate(data, start=1):
-        start_time = time_to_webvtt_timestamp(entry["start"])
-        end_time = time_to_webvtt_timestamp(entry["end"])
-        text = entry["text"].replace("\n", " ")
+        if changed:
+            self._vtt = self._vtt_bytes = None
+        return changed
 
-        webvtt_content += f"{index}\n{start_time} --> {end_time}\n{text}\n\n"
+    @property
+    def vtt(self) -> str:
+        if self._vtt is None:
+            self._vtt = "WEBVTT\n\n" + "".join(self._cues)
+        return self._vtt
 
-    return webvtt_content
+    @property
+    def vtt_bytes(self) -> bytes:
+        if self._vtt_bytes is None:
+            self._vtt_bytes = self.vtt.encode("utf-8")
+        return self._vtt_bytes